@@ -0,0 +1,208 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import design_matrix
+import diagnostics
+import experiment_runner
+import experimentalist
+import information_gain
+import read_experiment_data
+import simulated_participant
+import theorist
+
+# Problem sizes of every suite; --quick uses the first entries only
+SIZES = {
+    'mcmc_trials': [100, 1000, 10000],
+    'mcmc_features': [4, 8, 16],
+    'parse_trials': [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6],
+    'acquisition_candidates': [10, 100, 1000, 10000],
+    'synthesis_sequences': [1, 5],
+}
+
+# Largest file parsed with json.load in the parse suite, to bound its memory use
+MAX_BASELINE_TRIALS = 10 ** 5
+
+
+def timed(function, *args, **kwargs):
+    """
+    Call function with printing suppressed.
+    Returns:
+    tuple: Result and wall-clock seconds.
+    """
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def random_timelines(n_timelines, n_trials=33, seed=0):
+    """
+    Timelines with uniformly drawn conditions, standing in for SweetPea output.
+    """
+    rng = random.Random(seed)
+    return [[{'word': rng.choice(experiment_runner.WORDS), 'color': rng.choice(experiment_runner.COLORS),
+              'response_transition': '' if trial == 0 else rng.choice(experiment_runner.RESPONSE_TRANSITIONS[1:])}
+             for trial in range(n_trials)] for _ in range(n_timelines)]
+
+
+def benchmark_mcmc(seed, quick=False, n_samples=4000, n_chains=4):
+    """
+    MCMC throughput (samples per second) and efficiency (minimum ESS per second) of every
+    sampler against the number of trials and features, with the maximum split-R-hat so that
+    chains which have not converged are not mistaken for slow ones.
+    The regression has no intercept and unit-scale coefficients and noise, the scale on which
+    the fixed proposal step of plain MH is meaningful.
+    """
+    results = []
+    trial_counts = SIZES['mcmc_trials'][:2] if quick else SIZES['mcmc_trials']
+    feature_counts = SIZES['mcmc_features'][:2] if quick else SIZES['mcmc_features']
+    for n_trials in trial_counts:
+        for n_features in feature_counts:
+            rng = np.random.default_rng(seed)
+            X = rng.normal(size=(n_trials, n_features))
+            y = X @ rng.normal(size=n_features) + rng.normal(size=n_trials)
+            for backend, options in [('mh', {}), ('mh-adaptive', {'adaptive': True}), ('hmc', {'backend': 'hmc'}),
+                                     ('conjugate', {'backend': 'conjugate'})]:
+                (beta, _), seconds = timed(theorist.run_theory, 'initial', None, None, n_samples, 0.05, X, y,
+                                           n_chains=n_chains, rng=seed, n_warmup=500, **options)
+                # run_theory pools the chains chain-major; restore (n_draws, n_chains, n_params) for the diagnostics
+                chains = 1 if backend == 'conjugate' else n_chains
+                draws = beta[:len(beta) // chains * chains].reshape((chains, -1, n_features)).transpose(1, 0, 2)
+                ess = float(np.min(diagnostics.effective_sample_size(draws)))
+                rhat = float(np.max(diagnostics.split_rhat(draws)))
+                results.append({'suite': 'mcmc', 'backend': backend, 'n_trials': n_trials, 'n_features': n_features,
+                                'n_samples': len(beta), 'seconds': seconds, 'samples_per_second': len(beta) / seconds,
+                                'min_ess': ess, 'ess_per_second': ess / seconds, 'max_rhat': rhat})
+    return results
+
+
+def benchmark_parse(seed, quick=False):
+    """
+    Throughput of the streaming columnar parser, and of json.load with filter_experiment_data
+    up to MAX_BASELINE_TRIALS, on files of simulated sessions.
+    """
+    results = []
+    participant = simulated_participant.SimulatedParticipant(rng=seed)
+    timeline = random_timelines(1, seed=seed)[0]
+    session = json.dumps(participant.session_records(timeline))[1:-1]
+    with tempfile.TemporaryDirectory() as directory:
+        for n_trials in SIZES['parse_trials'][:2] if quick else SIZES['parse_trials']:
+            # One array holding the records of repeated copies of the session
+            path = os.path.join(directory, f'{n_trials}.json')
+            with open(path, 'w') as file:
+                file.write('[' + ','.join([session] * -(-n_trials // len(timeline))) + ']')
+            size = os.path.getsize(path)
+
+            columns, seconds = timed(read_experiment_data.read_experiment_columns, path)
+            results.append({'suite': 'parse', 'parser': 'read_experiment_columns', 'n_trials': len(columns['rt']),
+                            'megabytes': size / 1e6, 'seconds': seconds, 'trials_per_second': len(columns['rt']) / seconds,
+                            'megabytes_per_second': size / 1e6 / seconds})
+            if n_trials <= MAX_BASELINE_TRIALS:
+                def baseline():
+                    with open(path, 'r') as file:
+                        return read_experiment_data.filter_experiment_data(json.load(file))
+                frame, seconds = timed(baseline)
+                results.append({'suite': 'parse', 'parser': 'json.load', 'n_trials': len(frame), 'megabytes': size / 1e6,
+                                'seconds': seconds, 'trials_per_second': len(frame) / seconds,
+                                'megabytes_per_second': size / 1e6 / seconds})
+            os.remove(path)
+    return results
+
+
+def benchmark_acquisition(seed, quick=False, n_samples=5000):
+    """
+    Latency of choosing among candidate timelines: the uncertainty criterion of
+    experimentalist.select_timeline and the expected information gain with a fixed number of draws.
+    """
+    results = []
+    rng = np.random.default_rng(seed)
+    participant = simulated_participant.SimulatedParticipant(rng=seed)
+    posterior = theorist.PosteriorState.initial(len(design_matrix.FEATURE_NAMES))
+    for timeline in random_timelines(2, seed=seed):
+        rt, _ = participant.respond([timeline])
+        posterior.update(design_matrix.encode(timeline), np.nan_to_num(rt, nan=3000))
+    beta_samples, _ = posterior.sample(n_samples, rng)
+
+    for n_candidates in SIZES['acquisition_candidates'][:2] if quick else SIZES['acquisition_candidates']:
+        timelines = random_timelines(n_candidates, seed=seed + 1)
+        # Clear the scorer's cache so every measurement includes scoring the posterior draws
+        experimentalist.SCORER._cache.clear()
+        _, seconds = timed(experimentalist.select_timeline, timelines, beta_samples)
+        results.append({'suite': 'acquisition', 'method': 'uncertainty', 'n_candidates': n_candidates,
+                        'seconds': seconds})
+        _, seconds = timed(information_gain.select_timeline, timelines, posterior, max_draws=256, rng=seed)
+        results.append({'suite': 'acquisition', 'method': 'information_gain', 'n_candidates': n_candidates,
+                        'n_draws': 256, 'seconds': seconds})
+    return results
+
+
+def benchmark_synthesis(seed, quick=False):
+    """
+    SweetPea synthesis latency of every generator.
+    """
+    results = []
+    for iteration in experiment_runner.GENERATORS:
+        for n_sequences in SIZES['synthesis_sequences'][:1] if quick else SIZES['synthesis_sequences']:
+            # RandomGen draws from random, CMSGen from np.random
+            random.seed(seed)
+            np.random.seed(seed)
+            timelines, seconds = timed(experiment_runner.sample_trials, iteration, n_sequences)
+            results.append({'suite': 'synthesis', 'generator': experiment_runner.GENERATORS[iteration][0],
+                            'n_sequences': len(timelines), 'seconds': seconds,
+                            'seconds_per_sequence': seconds / len(timelines)})
+    return results
+
+
+SUITES = {
+    'mcmc': benchmark_mcmc,
+    'parse': benchmark_parse,
+    'acquisition': benchmark_acquisition,
+    'synthesis': benchmark_synthesis,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of synthesis, ingestion, fitting and acquisition.')
+    parser.add_argument('--suites', nargs='+', choices=list(SUITES), default=list(SUITES),
+                        help='suites to run (default: all)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of all random inputs')
+    parser.add_argument('--quick', action='store_true', help='run the smallest problem sizes only')
+    parser.add_argument('--output', help='file to write the JSON results to (default: stdout)')
+    args = parser.parse_args(argv)
+
+    report = {
+        'seed': args.seed,
+        'quick': args.quick,
+        'time': time.time(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'results': [],
+    }
+    for suite in args.suites:
+        print(f'Running {suite} benchmarks', file=sys.stderr)
+        report['results'].extend(SUITES[suite](args.seed, args.quick))
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text)
+    else:
+        print(text)
+    return report
+
+
+if __name__ == '__main__':
+    main()
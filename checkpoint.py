@@ -0,0 +1,132 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+import theorist
+
+# Root directory of the checkpoints of the closed loop
+CHECKPOINT_DIR = os.path.expanduser('~/.local/share/closed-loop-experiment/checkpoints')
+
+
+def restore_rng(state):
+    """
+    Create a random generator continuing from a saved bit-generator state.
+    """
+    rng = np.random.default_rng()
+    rng.bit_generator.state = state
+    return rng
+
+
+class Checkpointer:
+    """
+    Checkpoints of the closed loop's state after every iteration.
+    Every iteration gets its own directory holding the posterior summary (posterior.npz), the
+    posterior samples as .npy files that are loaded back as read-only memory maps, and
+    state.json with the chosen timeline, the collected results and the states of the random
+    generators. The directory is written under a temporary name and renamed when complete,
+    so a crash while saving leaves the previous checkpoint as the latest one.
+    Parameters:
+    directory (str): Directory of the checkpoints.
+    """
+
+    def __init__(self, directory=CHECKPOINT_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, iteration):
+        return os.path.join(self.directory, f'iteration_{iteration:03d}')
+
+    def iterations(self):
+        """
+        Completed checkpoints, in iteration order.
+        """
+        return sorted(int(name.split('_')[1]) for name in os.listdir(self.directory)
+                      if name.startswith('iteration_') and name.split('_')[1].isdigit())
+
+    def save(self, iteration, posterior, beta_samples, sigma2_samples, timeline, results, rngs=None):
+        """
+        Checkpoint the state after an iteration. Checkpoints of later iterations, left by an
+        earlier run, are removed.
+        Parameters:
+        iteration (int): Completed loop iteration.
+        posterior (PosteriorState): Posterior after the iteration.
+        beta_samples (array-like): Posterior samples of beta, shape (n_samples, n_params).
+        sigma2_samples (array-like): Posterior samples of sigma2, shape (n_samples,).
+        timeline (list): Trial dictionaries of the timeline that was run.
+        results (DataFrame or dict): Results of the timeline, as returned by closed_loop.collect_results.
+        rngs (dict, optional): Random generators by name, e.g. {'loop': rng}, whose states are saved.
+        Returns:
+        str: Directory of the checkpoint.
+        """
+        path = self._path(iteration)
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        os.makedirs(temporary_path)
+        np.savez(os.path.join(temporary_path, 'posterior.npz'), mean=posterior.mean, precision=posterior.precision,
+                 a=posterior.a, b=posterior.b, n_trials=posterior.n_trials)
+        np.save(os.path.join(temporary_path, 'beta_samples.npy'), np.asarray(beta_samples, dtype=float))
+        np.save(os.path.join(temporary_path, 'sigma2_samples.npy'), np.asarray(sigma2_samples, dtype=float))
+        results = {name: np.asarray(results[name]).tolist() for name in results}
+        state = {
+            'iteration': iteration,
+            'timeline': timeline,
+            'results': results,
+            'rngs': {name: rng.bit_generator.state for name, rng in (rngs or {}).items()},
+        }
+        with open(os.path.join(temporary_path, 'state.json'), 'w') as file:
+            json.dump(state, file)
+
+        # Replace an older checkpoint of the same iteration and drop the ones after it
+        for later in self.iterations():
+            if later >= iteration:
+                shutil.rmtree(self._path(later))
+        os.replace(temporary_path, path)
+        return path
+
+    def load(self, iteration=None):
+        """
+        Load a checkpoint.
+        Parameters:
+        iteration (int, optional): Iteration to load; the latest one if None.
+        Returns:
+        dict: iteration, posterior (PosteriorState), beta_samples and sigma2_samples (memory-mapped),
+        timeline, results (dict of lists) and rngs (dict of restored generators), or None without checkpoints.
+        """
+        if iteration is None:
+            iterations = self.iterations()
+            if not iterations:
+                return None
+            iteration = iterations[-1]
+        path = self._path(iteration)
+        with np.load(os.path.join(path, 'posterior.npz')) as arrays:
+            posterior = theorist.PosteriorState(arrays['mean'], arrays['precision'], float(arrays['a']),
+                                                float(arrays['b']))
+            posterior.n_trials = int(arrays['n_trials'])
+        with open(os.path.join(path, 'state.json'), 'r') as file:
+            state = json.load(file)
+        state['posterior'] = posterior
+        state['beta_samples'] = np.load(os.path.join(path, 'beta_samples.npy'), mmap_mode='r')
+        state['sigma2_samples'] = np.load(os.path.join(path, 'sigma2_samples.npy'), mmap_mode='r')
+        state['rngs'] = {name: restore_rng(rng_state) for name, rng_state in state['rngs'].items()}
+        return state
+
+    def history(self):
+        """
+        Timelines and results of every checkpointed iteration, in iteration order.
+        Returns:
+        list: (timeline, results) pairs.
+        """
+        history = []
+        for iteration in self.iterations():
+            with open(os.path.join(self._path(iteration), 'state.json'), 'r') as file:
+                state = json.load(file)
+            history.append((state['timeline'], state['results']))
+        return history
+
+    def clear(self):
+        """
+        Remove all checkpoints.
+        """
+        for iteration in self.iterations():
+            shutil.rmtree(self._path(iteration))
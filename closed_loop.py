@@ -1,134 +1,198 @@
+import argparse
+import concurrent.futures
+import os
 import time
 
 import numpy as np
 import pandas as pd
 
+import checkpoint
+import design_matrix
 import experiment_runner
+import experiment_server
 import experimentalist
+import information_gain
+import instrumentation
 import read_experiment_data
 import theorist
-
-# Loop through 5 iterations
-for i in range(5):
-    if i == 0:
-        # Sample initial trials and run the experiment
-        timelines = experiment_runner.sample_trials('initial')
-        experiment_runner.run_experiment(timelines[0])
-        timeline0 = pd.DataFrame.from_dict(timelines[0])
-
-        # Print the initial timeline
-        print(timeline0)
-        time.sleep(50)  # Wait for 50 seconds
-        filtered_df = read_experiment_data.read_experiment_data()
-        # Update timeline with response time and response data
-        timeline0['rt'] = filtered_df['rt']
-        timeline0['response'] = filtered_df['response']
-
-        # Encode categorical variables
-        df_encoded = pd.get_dummies(timeline0[['word', 'color', 'response_transition']], drop_first=True)
-
-        # Prepare training data
-        X_train = df_encoded.values
-        y_train = timeline0['rt'].values
-
-        # Step 8: Run MCMC sampling for Bayesian linear regression
-        n_samples_mcmc = 5000  # Number of MCMC samples
-        step_size = 0.1  # Step size for proposals
-        beta_samples_train, sigma2_samples_train = theorist.run_theory(
-            iteration='initial',
-            posterior_means=0,
-            posterior_variances=0,
-            n_samples_mcmc=n_samples_mcmc,
-            step_size=step_size,
-            X_train=X_train,
-            y_train=y_train
-        )
-    elif i < 2:
-        # Sample initial trials and run the experiment
-        timelines = experiment_runner.sample_trials('initial')
-        experiment_runner.run_experiment(timelines[0])
-        timeline0 = pd.DataFrame.from_dict(timelines[0])
-
-        time.sleep(50)  # Wait for 50 seconds
-        filtered_df = read_experiment_data.read_experiment_data()
-        # Update timeline with response time and response data
-        timeline0['rt'] = filtered_df['rt']
-        timeline0['response'] = filtered_df['response']
-
-        # Encode categorical variables
-        df_encoded = pd.get_dummies(timeline0[['word', 'color', 'response_transition']], drop_first=True)
-
-        # Prepare training data
-        X_train = df_encoded.values
-        y_train = timeline0['rt'].values
-
-        # Update posterior means and variables
-        posterior_means = np.mean(beta_samples_train, axis=0)
-        posterior_variances = np.var(beta_samples_train, axis=0)
-        beta_samples_train, sigma2_samples_train = theorist.run_theory(
-            iteration='update',
-            posterior_means=posterior_means,
-            posterior_variances=posterior_variances,
-            n_samples_mcmc=n_samples_mcmc,
-            step_size=step_size,
-            X_train=X_train,
-            y_train=y_train
-        )
-    else:
-        # Sample initial trials
-        timelines = experiment_runner.sample_trials('initial')
-        timeline0 = pd.DataFrame.from_dict(timelines[0])
-
-        # Sample condition with maximum uncertainty
-        maximum_uncertainty = experimentalist.sample_condition(timeline0, beta_samples_train)
-        timeline0_as_a_dictionary = timeline0.iloc[maximum_uncertainty].to_dict()
-        print(timeline0_as_a_dictionary)
-
-        # Sample updated trials
-        timelines = experiment_runner.sample_trials('update')
-
-        # Calculate frequency of the condition in updated trials
-        frequency = []
-        for i in range(len(timelines)):
-            p = 0
-            timeline = timelines[i]
-            for j in range(len(timeline)):
-
-                if timeline[j]['word'] == timeline0_as_a_dictionary['word'] and timeline[j]['color'] == \
-                    timeline0_as_a_dictionary['color'] and timeline[j]['response_transition'] == \
-                    timeline0_as_a_dictionary['response_transition']:
-                    p = p + 1
-            frequency.append(p)
-
-        # Find the timeline with maximum frequency
-        max_frequency = np.argmax(frequency)
-
-        # Run the experiment with the timeline having maximum frequency
-        timeline0 = pd.DataFrame.from_dict(timelines[max_frequency])
-        experiment_runner.run_experiment(timelines[max_frequency])
-
-        time.sleep(50)  # Wait for 50 seconds
-        filtered_df = read_experiment_data.read_experiment_data()
-        # Update timeline with response time and response data
-        timeline0['rt'] = filtered_df['rt']
-        timeline0['response'] = filtered_df['response']
-
-        # Encode categorical variables
-        df_encoded = pd.get_dummies(timeline0[['word', 'color', 'response_transition']], drop_first=True)
-
-        # Prepare training data
-        X_train = df_encoded.values
-        y_train = timeline0['rt'].values
-
-        # Update posterior means and variances
-        posterior_means = np.mean(beta_samples_train, axis=0)
-        posterior_variances = np.var(beta_samples_train, axis=0)
-        beta_samples_train, sigma2_samples_train = theorist.run_theory(
-            iteration='update',
-            posterior_means=posterior_means,
-            posterior_variances=posterior_variances,
-            n_samples_mcmc=n_samples_mcmc,
-            step_size=step_size,
-            X_train=X_train,
-            y_train=y_train
-        )
+import trial_cache
+import trial_store
+
+
+def collect_results(timeline, server=None, participant=None, session_timeout=1800):
+    """
+    Run the experiment of a timeline and wait for the participant's results.
+    Parameters:
+    timeline (list): Trial dictionaries of the timeline.
+    server (ExperimentServer, optional): Server receiving the results; the browser's download otherwise.
+    participant (SimulatedParticipant, optional): Headless participant answering instead of a person.
+    session_timeout (float): Seconds to wait for the results, e.g. before giving up on a closed tab.
+    Returns:
+    DataFrame: Response time, response, word and color of every Stroop trial.
+    Raises:
+    TimeoutError: If no results arrived within session_timeout seconds.
+    """
+    with instrumentation.span('participant', simulated=participant is not None):
+        if participant is not None:
+            data = participant.session_records(timeline)
+        elif server is None:
+            # Wait for the downloaded results file instead of a fixed delay
+            started = time.time()
+            experiment_runner.run_experiment(timeline)
+            return read_experiment_data.read_experiment_data(read_experiment_data.wait_for_experiment_data(
+                timeout=session_timeout, newer_than=started))
+        else:
+            session_id = experiment_runner.run_experiment(timeline, server=server)
+            try:
+                data = server.wait_for_results(session_id, session_timeout)
+            except concurrent.futures.TimeoutError:
+                raise TimeoutError(f"No results of session {session_id} after {session_timeout} seconds") from None
+            finally:
+                server.close_session(session_id)
+    return read_experiment_data.filter_experiment_data(data)
+
+
+def encode_results(timeline, filtered_df):
+    """
+    Join the participant's results to a timeline and encode it for the theorist.
+    Parameters:
+    timeline (list): Trial dictionaries of the timeline.
+    filtered_df (DataFrame): Results of the timeline, as returned by collect_results.
+    Returns:
+    tuple: Design matrix X_train and reaction times y_train.
+    Raises:
+    ValueError: If the results do not match the timeline trial by trial.
+    """
+    read_experiment_data.check_timeline(timeline, filtered_df)
+    timeline0 = pd.DataFrame.from_dict(timeline)
+    # Update timeline with response time and response data
+    timeline0['rt'] = filtered_df['rt']
+    timeline0['response'] = filtered_df['response']
+
+    # Encode categorical variables with the fixed design-matrix schema
+    X_train = design_matrix.encode(timeline0)
+
+    # Prepare training data
+    y_train = timeline0['rt'].values
+    return X_train, y_train
+
+
+def choose_timeline(update_pool, beta_samples, n_candidates=100, posterior=None, time_budget=5.0):
+    """
+    Pick the candidate timeline with the largest expected information gain when the posterior
+    is given, otherwise the one whose trials carry the most summed prediction uncertainty.
+    Parameters:
+    update_pool (TrialPool): Pool of the candidate timelines.
+    beta_samples (array-like): Posterior samples of the regression coefficients.
+    n_candidates (int): Number of candidate timelines.
+    posterior (PosteriorState, optional): Current posterior, enabling the information-gain criterion.
+    time_budget (float): Seconds the information-gain estimate may take.
+    Returns:
+    list: Trial dictionaries of the chosen timeline.
+    """
+    while True:
+        # Score candidates of the pool in one pass and remove only the best one from it
+        names, timelines = zip(*update_pool.candidates(n_candidates))
+        if posterior is None:
+            best = experimentalist.select_timeline(timelines, beta_samples)
+        else:
+            best = information_gain.select_timeline(timelines, posterior, time_budget=time_budget)
+        timeline = update_pool.claim(names[best])
+        # Choose again if another consumer claimed the timeline meanwhile
+        if timeline is not None:
+            print(f"Selected candidate timeline {best} of {len(timelines)}")
+            return timeline
+
+
+def main(participant=None, trace_path=None, resume=False, checkpoint_dir=checkpoint.CHECKPOINT_DIR,
+         session_timeout=1800):
+    # Record per-stage timings when a trace file is requested
+    trace_path = trace_path or os.environ.get('CLOSED_LOOP_TRACE')
+    if trace_path:
+        instrumentation.enable()
+
+    pools = []
+    try:
+        # Local server handing out the experiment pages and receiving their results, unless the participant is simulated
+        server = None if participant is not None else experiment_server.ExperimentServer().start_in_background()
+
+        # Pools of pre-synthesized timelines, refilled in the background
+        initial_pool = trial_cache.TrialPool('initial')
+        update_pool = trial_cache.TrialPool('update', target_size=200, parallel=True)
+        pools = [initial_pool, update_pool]
+        n_candidates = 100  # Candidate timelines the experimentalist chooses from
+        n_samples_mcmc = 5000  # Number of posterior samples
+
+        # Every collected trial is kept in the persistent trial store
+        store = trial_store.TrialStore()
+
+        # The state after every iteration is checkpointed; resume continues after the latest checkpoint
+        checkpoints = checkpoint.Checkpointer(checkpoint_dir)
+        rng = np.random.default_rng()
+        start = 0
+        state = checkpoints.load() if resume else None
+        if state is not None:
+            start = state['iteration'] + 1
+            posterior = state['posterior']
+            beta_samples_train = state['beta_samples']
+            rng = state['rngs']['loop']
+            if participant is not None and 'participant' in state['rngs']:
+                participant.rng = state['rngs']['participant']
+            print(f"Resuming after iteration {state['iteration']}")
+        elif not resume:
+            checkpoints.clear()
+
+        # Loop through 5 iterations
+        for i in range(start, 5):
+            with instrumentation.span('iteration', iteration=i):
+                if i < 2:
+                    # Sample initial trials
+                    timeline = initial_pool.take(1)[0]
+                    if i == 0:
+                        # Print the initial timeline
+                        print(pd.DataFrame.from_dict(timeline))
+                else:
+                    # Run the candidate timeline with the largest expected information gain
+                    timeline = choose_timeline(update_pool, beta_samples_train, n_candidates, posterior)
+
+                # Run the experiment, check and encode the results, and only then store them
+                try:
+                    filtered_df = collect_results(timeline, server, participant, session_timeout)
+                except TimeoutError:
+                    # The iterations before this one are checkpointed and can be resumed
+                    print(f"Iteration {i} got no results; run again with --resume to repeat it")
+                    raise
+                X_train, y_train = encode_results(timeline, filtered_df)
+                store.append(timeline, filtered_df, i)
+
+                # Step 8: Fit the Bayesian linear regression, absorbing every new block into the running posterior
+                with instrumentation.span('theorist', backend='conjugate'):
+                    if i == 0:
+                        posterior = theorist.PosteriorState.initial(X_train.shape[1])
+                    posterior.update(X_train, y_train)
+                    beta_samples_train, sigma2_samples_train = posterior.sample(n_samples_mcmc, rng)
+                instrumentation.count('theorist.trials', len(y_train))
+                instrumentation.count('theorist.samples', n_samples_mcmc)
+
+                rngs = {'loop': rng}
+                if participant is not None:
+                    rngs['participant'] = participant.rng
+                checkpoints.save(i, posterior, beta_samples_train, sigma2_samples_train, timeline, filtered_df, rngs)
+    finally:
+        # Stop the refills and their worker processes before the interpreter shuts down
+        for pool in pools:
+            pool.close()
+        # Write the trace also when an iteration fails, which is when it is needed most
+        if trace_path:
+            instrumentation.export(trace_path)
+            print(instrumentation.summary())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the closed-loop Stroop experiment.')
+    parser.add_argument('--resume', action='store_true', help='continue after the latest checkpoint')
+    parser.add_argument('--trace', help='file to write the per-stage timings to')
+    parser.add_argument('--session-timeout', type=float, default=1800,
+                        help='seconds to wait for the results of a session (default: 1800)')
+    args = parser.parse_args()
+    main(trace_path=args.trace, resume=args.resume, session_timeout=args.session_timeout)
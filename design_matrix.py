@@ -0,0 +1,75 @@
+import numpy as np
+
+import experiment_runner
+
+# Factors of the RT model, in the order of experiment_runner.condition_codes
+FACTORS = ['word', 'color', 'response_transition']
+
+# Levels of every factor, sorted as pd.get_dummies sorts them; the first one is the dropped baseline
+FACTOR_LEVELS = {
+    'word': sorted(experiment_runner.WORDS),
+    'color': sorted(experiment_runner.COLORS),
+    'response_transition': sorted(experiment_runner.RESPONSE_TRANSITIONS),
+}
+
+# Names of the design-matrix columns, as pd.get_dummies(..., drop_first=True) names them for a full timeline
+FEATURE_NAMES = [f'{factor}_{level}' for factor in FACTORS for level in FACTOR_LEVELS[factor][1:]]
+
+
+def build_condition_matrix():
+    """
+    Build the design-matrix row of every word x color x response transition condition.
+    Returns:
+    array-like: Matrix of shape (n_conditions, n_features), indexed by experiment_runner.condition_codes.
+    """
+    words, colors, transitions = np.meshgrid(experiment_runner.WORDS, experiment_runner.COLORS,
+                                             experiment_runner.RESPONSE_TRANSITIONS, indexing='ij')
+    conditions = {'word': words.ravel(), 'color': colors.ravel(), 'response_transition': transitions.ravel()}
+    codes = experiment_runner.condition_codes(conditions['word'], conditions['color'],
+                                              conditions['response_transition'])
+
+    # One indicator column per non-baseline level, in the order of FEATURE_NAMES
+    indicators = [conditions[factor] == level for factor in FACTORS for level in FACTOR_LEVELS[factor][1:]]
+    matrix = np.zeros((len(codes), len(FEATURE_NAMES)))
+    matrix[codes] = np.stack(indicators, axis=1)
+    return matrix
+
+
+# Design-matrix rows of all conditions, built once
+CONDITION_MATRIX = build_condition_matrix()
+
+
+def trial_conditions(trials):
+    """
+    Condition code of every trial.
+    Parameters:
+    trials (list, DataFrame or dict): Timeline as a list of trial dictionaries, or columns word, color and response_transition.
+    Returns:
+    array-like: Condition codes, one per trial; -1 for levels outside the design.
+    """
+    if isinstance(trials, list):
+        trials = {factor: [trial[factor] for trial in trials] for factor in FACTORS}
+    return experiment_runner.condition_codes(*(trials[factor] for factor in FACTORS))
+
+
+def encode_conditions(codes):
+    """
+    Gather the design-matrix rows of trials given by their condition codes.
+    """
+    codes = np.asarray(codes)
+    if np.any(codes < 0):
+        raise ValueError(f'{np.sum(codes < 0)} trials have levels outside the design')
+    return CONDITION_MATRIX[codes]
+
+
+def encode(trials):
+    """
+    Encode trials into the fixed-schema design matrix of the RT model.
+    Every trial is mapped to its condition code and the matrix is gathered from
+    CONDITION_MATRIX, so the columns are always FEATURE_NAMES, whichever levels occur.
+    Parameters:
+    trials (list, DataFrame or dict): Timeline as a list of trial dictionaries, or columns word, color and response_transition.
+    Returns:
+    array-like: Design matrix of shape (n_trials, n_features).
+    """
+    return encode_conditions(trial_conditions(trials))
@@ -0,0 +1,138 @@
+import numpy as np
+
+
+def autocovariance(samples):
+    """
+    Compute the autocovariance of every chain with an FFT.
+    Parameters:
+    samples (array-like): Draws of shape (n_draws, n_chains, ...).
+    Returns:
+    array-like: Autocovariance at lags 0 .. n_draws - 1, same shape as samples.
+    """
+    samples = np.asarray(samples, dtype=float)
+    n_draws = samples.shape[0]
+    centered = samples - np.mean(samples, axis=0)
+    size = 2 ** int(np.ceil(np.log2(2 * n_draws)))
+    spectrum = np.fft.rfft(centered, n=size, axis=0)
+    return np.fft.irfft(spectrum * np.conjugate(spectrum), n=size, axis=0)[:n_draws] / n_draws
+
+
+def effective_sample_size(samples):
+    """
+    Multi-chain effective sample size with Geyer's initial monotone sequence estimator.
+    Parameters:
+    samples (array-like): Draws of shape (n_draws, n_chains) or (n_draws, n_chains, n_params).
+    Returns:
+    array-like: Effective sample size of every parameter, shape () or (n_params,).
+    """
+    samples = np.asarray(samples, dtype=float)
+    n_draws, n_chains = samples.shape[:2]
+    acov = autocovariance(samples)
+
+    # Combine the within-chain autocorrelations with the between-chain variance
+    within_variance = np.mean(acov[0], axis=0) * n_draws / (n_draws - 1)
+    between_variance = np.var(np.mean(samples, axis=0), axis=0, ddof=1) if n_chains > 1 else 0
+    variance_plus = within_variance * (n_draws - 1) / n_draws + between_variance
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rho = 1 - (within_variance - np.mean(acov, axis=1)) / variance_plus
+    rho[0] = 1
+
+    # Sum consecutive pairs until the first negative one, forcing them to be monotone
+    n_pairs = n_draws // 2
+    pairs = rho[0:2 * n_pairs:2] + rho[1:2 * n_pairs:2]
+    positive = np.cumprod(pairs > 0, axis=0).astype(bool)
+    pairs = np.minimum.accumulate(np.where(positive, pairs, 0), axis=0)
+    tau = -1 + 2 * np.sum(pairs, axis=0)
+    return n_draws * n_chains / np.maximum(tau, 1 / np.log10(n_draws * n_chains))
+
+
+def split_chains(samples):
+    """
+    Split every chain into its first and second half, doubling the number of chains.
+    Parameters:
+    samples (array-like): Draws of shape (n_draws, n_chains, ...).
+    Returns:
+    array-like: Draws of shape (n_draws // 2, 2 * n_chains, ...).
+    """
+    samples = np.asarray(samples, dtype=float)
+    half = samples.shape[0] // 2
+    return np.concatenate([samples[:half], samples[samples.shape[0] - half:]], axis=1)
+
+
+def rank_normalize(samples):
+    """
+    Replace every draw by the normal quantile of its rank among all draws of the same parameter.
+    Parameters:
+    samples (array-like): Draws of shape (n_draws, n_chains, ...).
+    Returns:
+    array-like: Rank-normalized draws of the same shape.
+    """
+    samples = np.asarray(samples, dtype=float)
+    n_total = samples.shape[0] * samples.shape[1]
+    flat = samples.reshape((n_total, -1))
+    ranks = np.argsort(np.argsort(flat, axis=0, kind='stable'), axis=0) + 1
+    return normal_quantile((ranks - 0.375) / (n_total + 0.25)).reshape(samples.shape)
+
+
+def normal_quantile(p):
+    """
+    Inverse CDF of the standard normal distribution (Acklam's rational approximation,
+    relative error below 1.2e-9).
+    """
+    p = np.asarray(p, dtype=float)
+    a = [-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+         1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00]
+    b = [-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+         6.680131188771972e+01, -1.328068155288572e+01]
+    c = [-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+         -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00]
+    d = [7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00, 3.754408661907416e+00]
+
+    # Rational approximation in the central region and in the (mirrored) tails
+    q = p - 0.5
+    r = q * q
+    central = (((((a[0] * r + a[1]) * r + a[2]) * r + a[3]) * r + a[4]) * r + a[5]) * q / \
+              (((((b[0] * r + b[1]) * r + b[2]) * r + b[3]) * r + b[4]) * r + 1)
+    t = np.sqrt(-2 * np.log(np.minimum(p, 1 - p)))
+    tail = (((((c[0] * t + c[1]) * t + c[2]) * t + c[3]) * t + c[4]) * t + c[5]) / \
+           ((((d[0] * t + d[1]) * t + d[2]) * t + d[3]) * t + 1)
+    tail = np.where(p < 0.5, tail, -tail)
+    return np.where(np.abs(q) <= 0.47575, central, tail)
+
+
+def potential_scale_reduction(samples):
+    """
+    Gelman-Rubin potential scale reduction of draws of shape (n_draws, n_chains, ...).
+    """
+    samples = np.asarray(samples, dtype=float)
+    n_draws = samples.shape[0]
+    within_variance = np.mean(np.var(samples, axis=0, ddof=1), axis=0)
+    between_variance = n_draws * np.var(np.mean(samples, axis=0), axis=0, ddof=1)
+    variance_plus = (n_draws - 1) / n_draws * within_variance + between_variance / n_draws
+    return np.sqrt(variance_plus / within_variance)
+
+
+def split_rhat(samples):
+    """
+    Rank-normalized split-R-hat (Vehtari et al., 2021): the larger of the split-R-hat of the
+    rank-normalized draws and of the rank-normalized draws folded around the median.
+    Parameters:
+    samples (array-like): Draws of shape (n_draws, n_chains) or (n_draws, n_chains, n_params).
+    Returns:
+    array-like: R-hat of every parameter.
+    """
+    split = split_chains(samples)
+    folded = np.abs(split - np.median(split.reshape((-1,) + split.shape[2:]), axis=0))
+    return np.maximum(potential_scale_reduction(rank_normalize(split)),
+                      potential_scale_reduction(rank_normalize(folded)))
+
+
+def bulk_effective_sample_size(samples):
+    """
+    Bulk effective sample size: the ESS of the rank-normalized split chains.
+    Parameters:
+    samples (array-like): Draws of shape (n_draws, n_chains) or (n_draws, n_chains, n_params).
+    Returns:
+    array-like: Bulk ESS of every parameter.
+    """
+    return effective_sample_size(rank_normalize(split_chains(samples)))
@@ -1,12 +1,19 @@
+import hashlib
+import inspect
+import json
 import os
+import random
 import webbrowser
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import pandas as pd
+import numpy as np
 from sweetpea import (
     Factor, WithinTrial, Transition, AtMostKInARow,
     CrossBlock, synthesize_trials, CMSGen, RandomGen, experiments_to_dicts
 )
 
+import instrumentation
+
 """
 Stroop Task
 ******************************
@@ -23,6 +30,22 @@ design:
 - no more than 7 response switches in a row
 """
 
+# Levels of the basic factors
+COLORS = ["red", "green", "blue", "yellow"]
+WORDS = ["red", "green", "blue", "yellow"]
+
+# Levels of the response transition as they appear in a timeline; the first trial has none ("")
+RESPONSE_TRANSITIONS = ["", "repeat", "switch"]
+
+# Maximum number of response repetitions or switches in a row
+MAX_TRANSITIONS_IN_A_ROW = 7
+
+# SweetPea sampler (name and options) per iteration type
+GENERATORS = {
+    "initial": ("CMSGen", {}),
+    "update": ("RandomGen", {"acceptable_error": 3}),
+}
+
 
 # Define congruency factor
 def congruent(color, word):
@@ -78,13 +101,13 @@ def is_negative_feedback(correct):
     return not correct
 
 
-def sample_trials(iteration):
+def build_block():
     from sweetpea import DerivedLevel
 
     # Define color and word factors
 
-    color      = Factor("color",  ["red", "green", "blue", "yellow"])
-    word       = Factor("word", ["red", "green", "blue", "yellow"])
+    color      = Factor("color",  COLORS)
+    word       = Factor("word", WORDS)
 
     # Define congruency levels based on color and word
     conLevel = DerivedLevel("con", WithinTrial(congruent,   [color, word]))
@@ -106,30 +129,146 @@ def sample_trials(iteration):
     ])
 
     # Define sequence constraints
-    k = 7
+    k = MAX_TRANSITIONS_IN_A_ROW
     constraints = [AtMostKInARow(k, resp_transition)]
 
     # Define experiment
     design       = [color, word, congruency, resp_transition, response]
     crossing     = [color, word, resp_transition]
 
-    block = CrossBlock(design, crossing, constraints)
-
-    # Solve
-    if iteration == "initial":
-        experiments  = synthesize_trials(block, 5, CMSGen)
-    else:
-        experiments  = synthesize_trials(block, 5, RandomGen(acceptable_error=3))
+    return CrossBlock(design, crossing, constraints)
+
+
+def level_codes(values, levels):
+    """
+    Position of every value in levels, -1 for values that are not a level.
+    """
+    unique, inverse = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+    codes = np.array([levels.index(value) if value in levels else -1 for value in unique], dtype=np.int16)
+    return codes[inverse.reshape(-1)]
+
+
+def condition_codes(words, colors, response_transitions):
+    """
+    Integer code of the word x color x response transition condition of every trial.
+    Parameters:
+    words, colors, response_transitions (array-like): Levels of the trials, as in a timeline.
+    Returns:
+    array-like: Codes in 0 .. len(WORDS) * len(COLORS) * len(RESPONSE_TRANSITIONS) - 1; -1 for unknown levels.
+    """
+    word = level_codes(words, WORDS)
+    color = level_codes(colors, COLORS)
+    transition = level_codes(response_transitions, RESPONSE_TRANSITIONS)
+    codes = (word * len(COLORS) + color) * len(RESPONSE_TRANSITIONS) + transition
+    return np.where((word < 0) | (color < 0) | (transition < 0), -1, codes).astype(np.int16)
+
+
+def make_generator(iteration):
+    """
+    Create the SweetPea sampler used for the given iteration type.
+    """
+    name, options = GENERATORS["initial" if iteration == "initial" else "update"]
+    if name == "CMSGen":
+        return CMSGen
+    return RandomGen(**options)
+
+
+def design_fingerprint(iteration):
+    """
+    Hash of everything that determines the synthesized sequences: factor levels, the source of
+    the derived-level predicates, crossing, constraints and sampler. Used as the cache key of
+    synthesized timelines.
+    Parameters:
+    iteration (str): 'initial' or 'update', selecting the sampler.
+    Returns:
+    str: Hex digest identifying the design.
+    """
+    predicates = [congruent, incongruent, response_r, response_g, response_b, response_y,
+                  response_repeat, response_switch]
+    description = {
+        "factors": {"color": COLORS, "word": WORDS},
+        "derived": [inspect.getsource(predicate) for predicate in predicates],
+        "block": inspect.getsource(build_block),
+        "crossing": ["color", "word", "response_transition"],
+        "constraints": [["AtMostKInARow", MAX_TRANSITIONS_IN_A_ROW, "response_transition"]],
+        "generator": GENERATORS["initial" if iteration == "initial" else "update"],
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def sample_trials(iteration, n_experiments=5):
+    with instrumentation.span("synthesis", iteration=iteration):
+        block = build_block()
+
+        # Solve
+        experiments  = synthesize_trials(block, n_experiments, make_generator(iteration))
+
+        # Convert experiments to dictionary format
+        timelines = experiments_to_dicts(block, experiments)
+    instrumentation.count("synthesis.sequences", len(timelines))
+    return timelines
 
-    # Convert experiments to dictionary format
-    exp_block = experiments_to_dicts(block, experiments)
-    timelines = experiments_to_dicts(block, experiments)
 
-    timeline0 = pd.DataFrame.from_dict(timelines[0])
+def sample_trials_shard(iteration, n_experiments, seed):
+    """
+    Worker of the parallel synthesis: seed the random generators SweetPea's samplers draw from
+    (random for RandomGen, numpy for the CMSGen solver seeds) and synthesize one shard.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    return sample_trials(iteration, n_experiments)
+
+
+def iter_trials_parallel(iteration, n_sequences, shard_size=5, max_workers=None, seed=None, executor=None):
+    """
+    Synthesize n_sequences timelines in shards spread over a process pool.
+    Every shard gets its own seed derived from seed, and shards are yielded as soon as they
+    finish, in completion order.
+    Parameters:
+    iteration (str): 'initial' or 'update', selecting the SweetPea sampler.
+    n_sequences (int): Total number of timelines.
+    shard_size (int): Number of timelines per SweetPea call.
+    max_workers (int, optional): Number of worker processes, all cores by default.
+    seed (int, optional): Root seed of the shards.
+    executor (ProcessPoolExecutor, optional): Pool to run the shards on, which is left running;
+    a new pool of max_workers processes, shut down at the end, by default.
+    Yields:
+    list: The timelines of one finished shard.
+    """
+    shard_sizes = [min(shard_size, n_sequences - start) for start in range(0, n_sequences, shard_size)]
+    seeds = [int(child.generate_state(1)[0]) for child in np.random.SeedSequence(seed).spawn(len(shard_sizes))]
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+    futures = []
+    try:
+        futures = [executor.submit(sample_trials_shard, iteration, size, shard_seed)
+                   for size, shard_seed in zip(shard_sizes, seeds)]
+        for future in as_completed(futures):
+            shard = future.result()
+            # The workers' counters stay in their processes, so count the sequences here
+            instrumentation.count("synthesis.sequences", len(shard))
+            yield shard
+    finally:
+        # Drop shards that have not started yet if the consumer stops early
+        if own_executor:
+            executor.shutdown(wait=True, cancel_futures=True)
+        else:
+            for future in futures:
+                future.cancel()
+
+
+def sample_trials_parallel(iteration, n_sequences, shard_size=5, max_workers=None, seed=None, executor=None):
+    """
+    Synthesize n_sequences timelines in parallel and return them as one list (see iter_trials_parallel).
+    """
+    timelines = []
+    for shard in iter_trials_parallel(iteration, n_sequences, shard_size, max_workers, seed, executor):
+        timelines.extend(shard)
     return timelines
 
 
-def run_experiment(timeline):
+def build_experiment(timeline):
     # imports
     from sweetbean.stimulus import TextStimulus
     from sweetbean.sequence import Block
@@ -229,36 +368,21 @@ def run_experiment(timeline):
 
     # Create the experiment from the two blocks
     experiment = Experiment([instructions_block, trial_block])
-    print(experiment)
-
-    # Construct the full path to the experimental.json file in the Downloads folder
-    downloads_folder = os.path.expanduser('~/Downloads')
-    experimental_file_path = os.path.join(downloads_folder, 'experimentData.json')
-
-    # Check if the experimental.json file exists and delete it if it does
-    if os.path.exists(experimental_file_path):
-        os.remove(experimental_file_path)
-        print(f"Deleted file: {experimental_file_path}")
-    else:
-        print(f"File not found: {experimental_file_path}")
+    return experiment
 
-    # export to the html file
-    experiment.to_html('index.html')
 
-    file_path = 'index.html'
-
-    # Define the target string and the replacement string
-    target_string = ''']
-;jsPsych.run(trials)'''
-
-    replacement_string = '''
-    ,{
+# Final trial: thank the participant and hand over the data with the given on_finish code
+FINISH_TRIAL = '''{
                 type: jsPsychHtmlKeyboardResponse,
                 stimulus: "<p>Thank you for participating!</p><p>Your responses have been recorded.</p><p>Press SPACE to finish.</p>",
                 choices: [" "],
                 on_finish: function() {
-                    // Once the participant presses SPACE, we download the data
-                    let data = jsPsych.data.get().json();
+%s
+                }
+            }'''
+
+# Once the participant presses SPACE, we download the data
+DOWNLOAD_DATA_JS = '''                    let data = jsPsych.data.get().json();
                     let blob = new Blob([data], { type: 'application/json' });
                     let url = URL.createObjectURL(blob);
                     let a = document.createElement('a');
@@ -267,25 +391,137 @@ def run_experiment(timeline):
                     document.body.appendChild(a);
                     a.click();
                     document.body.removeChild(a);
-                    URL.revokeObjectURL(url);
-                }
-            }]
-    ;jsPsych.run(trials)
-    '''
-
-    # Open the file and read its contents
-    with open(file_path, 'r', encoding='utf-8') as file:
-        content = file.read()
+                    URL.revokeObjectURL(url);'''
+
+# Once the participant presses SPACE, we post the data to the session URL of the experiment server
+POST_DATA_JS = '''                    fetch('data', {
+                        method: 'POST',
+                        headers: { 'Content-Type': 'application/json' },
+                        body: jsPsych.data.get().json()
+                    });'''
+
+
+def experiment_html(experiment, on_finish):
+    """
+    Render the experiment as a standalone HTML page whose last trial runs on_finish.
+    The page is assembled from the blocks' jsPsych code in memory, the way sweetbean's
+    Experiment.to_html lays it out, with the final trial appended to the trial list.
+    Parameters:
+    experiment (Experiment): The sweetbean experiment.
+    on_finish (str): JavaScript executed when the participant finishes, e.g. DOWNLOAD_DATA_JS.
+    Returns:
+    str: The HTML page.
+    """
+    from sweetbean.const import HTML_PREAMBLE, HTML_APPENDIX
+
+    trials = ",".join(block.text_js for block in experiment.blocks)
+    return (HTML_PREAMBLE + "jsPsych = initJsPsych();\ntrials = [\n" + trials + ",\n" + FINISH_TRIAL % on_finish
+            + "]\n;jsPsych.run(trials)" + HTML_APPENDIX)
+
+
+# Stand-in for the timeline in the compiled page template
+TIMELINE_PLACEHOLDER = "__CLOSED_LOOP_TIMELINE__"
+
+# Directory of the on-disk cache of compiled page templates
+TEMPLATE_DIR = os.path.expanduser("~/.cache/closed-loop-experiment/templates")
+
+# Compiled templates of this process, per on_finish code
+_templates = {}
+
+
+def template_key(on_finish):
+    """
+    Hash of everything that determines the page around the timeline: the sweetbean version,
+    the experiment definition, the page layout and the on_finish code.
+    """
+    from importlib.metadata import version
+
+    description = [version("sweetbean"), inspect.getsource(build_experiment), inspect.getsource(experiment_html),
+                   FINISH_TRIAL, on_finish]
+    return hashlib.sha256(json.dumps(description).encode("utf-8")).hexdigest()
+
+
+def load_template(on_finish):
+    """
+    Return the compiled page template for on_finish as the page text before and after the timeline.
+    The template is built once with a placeholder timeline and cached on disk, so other
+    processes and later sessions only read it.
+    """
+    if on_finish in _templates:
+        return _templates[on_finish]
+
+    path = os.path.join(TEMPLATE_DIR, template_key(on_finish) + ".json")
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            template = tuple(json.load(file))
+    except FileNotFoundError:
+        from sweetbean.sequence import Timeline
+
+        # sweetbean writes the name of a Timeline where the timeline variables go
+        page = experiment_html(build_experiment(Timeline(TIMELINE_PLACEHOLDER, "")), on_finish)
+        template = tuple(page.split(TIMELINE_PLACEHOLDER))
+        os.makedirs(TEMPLATE_DIR, exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            json.dump(template, file)
+        os.replace(temporary_path, path)
+
+    _templates[on_finish] = template
+    return template
+
+
+@instrumentation.traced("html")
+def render_page(timeline, on_finish):
+    """
+    Render the experiment page of a timeline from the compiled template.
+    Parameters:
+    timeline (list): Trial dictionaries of the timeline.
+    on_finish (str): JavaScript executed when the participant finishes, e.g. DOWNLOAD_DATA_JS.
+    Returns:
+    str: The HTML page.
+    """
+    head, tail = load_template(on_finish)
+    return head + json.dumps(timeline) + tail
+
+
+def run_experiment(timeline, server=None, compiled=True):
+    """
+    Render the experiment for a timeline and open it in the browser.
+    Without a server the page is written to index.html and the results are downloaded to
+    ~/Downloads/experimentData.json. With an ExperimentServer the page is served from a new
+    session and the results are posted back to it.
+    Parameters:
+    timeline (list): Trial dictionaries of the timeline.
+    server (ExperimentServer, optional): Running experiment server.
+    compiled (bool): Render from the cached page template instead of rebuilding the experiment.
+    Returns:
+    str: The session id when a server is used, otherwise None.
+    """
+    def page(on_finish):
+        if compiled:
+            return render_page(timeline, on_finish)
+        return experiment_html(build_experiment(timeline), on_finish)
+
+    if server is not None:
+        session_id = server.add_session(page(POST_DATA_JS))
+        webbrowser.open(server.url(session_id))
+        return session_id
 
-    # Replace the target string with the replacement string
-    modified_content = content.replace(target_string, replacement_string)
+    # Construct the full path to the experimental.json file in the Downloads folder
+    downloads_folder = os.path.expanduser('~/Downloads')
+    experimental_file_path = os.path.join(downloads_folder, 'experimentData.json')
 
-    # Write the modified content back to the file
-    with open(file_path, 'w', encoding='utf-8') as file:
-        file.write(modified_content)
+    # Check if the experimental.json file exists and delete it if it does
+    if os.path.exists(experimental_file_path):
+        os.remove(experimental_file_path)
+        print(f"Deleted file: {experimental_file_path}")
+    else:
+        print(f"File not found: {experimental_file_path}")
 
-    # Specify the path to your HTML file
+    # export to the html file
     file_path = 'index.html'
+    with open(file_path, 'w', encoding='utf-8') as file:
+        file.write(page(DOWNLOAD_DATA_JS))
 
     # Open the HTML file in the default web browser
     webbrowser.open('file://' + os.path.realpath(file_path))
@@ -0,0 +1,139 @@
+import asyncio
+import json
+import threading
+import uuid
+from concurrent.futures import Future
+from urllib.parse import urlsplit
+
+
+class ExperimentServer:
+    """
+    Local asyncio HTTP server that serves experiment pages and receives their results.
+    Every session has its own page at /sessions/<id>/ and the page posts the jsPsych data
+    to /sessions/<id>/data when the participant finishes. The posted records are handed to
+    the caller in memory through the session's future, so any number of tabs or stations
+    can run at the same time.
+    Parameters:
+    host (str): Interface to listen on; localhost by default.
+    port (int): Port to listen on; 0 picks a free port.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self._pages = {}
+        self._results = {}
+        self._server = None
+
+    async def start(self):
+        """
+        Start listening on the running event loop.
+        """
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        """
+        Stop listening and close the server.
+        """
+        self._server.close()
+        await self._server.wait_closed()
+
+    def start_in_background(self):
+        """
+        Run the server on its own event loop in a daemon thread, for callers without an event loop.
+        """
+        started = threading.Event()
+
+        def serve():
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(self.start())
+            started.set()
+            loop.run_forever()
+
+        threading.Thread(target=serve, daemon=True).start()
+        started.wait()
+        return self
+
+    def add_session(self, html):
+        """
+        Register a new session serving the given page.
+        Returns:
+        str: The session id.
+        """
+        session_id = uuid.uuid4().hex
+        self._pages[session_id] = html
+        self._results[session_id] = Future()
+        return session_id
+
+    def url(self, session_id):
+        """
+        URL of the page of a session.
+        """
+        return f'http://{self.host}:{self.port}/sessions/{session_id}/'
+
+    async def results(self, session_id, timeout=None):
+        """
+        Wait for the data of a session.
+        Returns:
+        list: The jsPsych trial records posted by the page.
+        """
+        return await asyncio.wait_for(asyncio.wrap_future(self._results[session_id]), timeout)
+
+    def wait_for_results(self, session_id, timeout=None):
+        """
+        Blocking version of results, for callers outside the server's event loop.
+        """
+        return self._results[session_id].result(timeout)
+
+    def close_session(self, session_id):
+        """
+        Forget a finished session.
+        """
+        self._pages.pop(session_id, None)
+        self._results.pop(session_id, None)
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            status, response_headers, payload = self._route(method, urlsplit(target).path, body)
+        except (ValueError, asyncio.IncompleteReadError):
+            status, response_headers, payload = '400 Bad Request', {'Content-Type': 'text/plain'}, b'Bad request'
+
+        response_headers.update({'Content-Length': len(payload), 'Connection': 'close'})
+        head = f'HTTP/1.1 {status}\r\n' + ''.join(f'{name}: {value}\r\n' for name, value in response_headers.items())
+        writer.write((head + '\r\n').encode('latin-1') + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def _route(self, method, path, body):
+        text = {'Content-Type': 'text/plain'}
+        parts = path.strip('/').split('/')
+        if len(parts) < 2 or parts[0] != 'sessions' or parts[1] not in self._pages:
+            return '404 Not Found', text, b'Unknown session'
+        session_id = parts[1]
+
+        if method == 'GET' and len(parts) == 2:
+            if not path.endswith('/'):
+                # Pages post to the relative URL 'data', so they must be served from a directory URL
+                return '301 Moved Permanently', {'Location': path + '/'}, b''
+            return '200 OK', {'Content-Type': 'text/html; charset=utf-8'}, self._pages[session_id].encode('utf-8')
+        if method == 'POST' and len(parts) == 3 and parts[2] == 'data':
+            future = self._results[session_id]
+            if future.done():
+                return '409 Conflict', text, b'Results already received'
+            future.set_result(json.loads(body))
+            return '200 OK', {'Content-Type': 'application/json'}, b'{"status": "ok"}'
+        return '405 Method Not Allowed', text, b'Unsupported request'
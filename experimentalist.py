@@ -1,5 +1,10 @@
+import hashlib
+from collections import OrderedDict
+
 import numpy as np
-import pandas as pd
+
+import design_matrix
+import instrumentation
 
 
 def sigmoid(z):
@@ -13,6 +18,83 @@ def sigmoid(z):
     return 1 / (1 + np.exp(-z))
 
 
+def partition_quantiles(samples, q):
+    """
+    Quantiles along the first axis with np.partition instead of a full sort, using the same
+    linear interpolation as np.percentile.
+    Parameters:
+    samples (array-like): Samples of shape (n_samples, ...).
+    q (array-like): Quantiles in [0, 1].
+    Returns:
+    array-like: Quantiles of shape (len(q), ...).
+    """
+    samples = np.asarray(samples)
+    positions = np.asarray(q, dtype=float) * (len(samples) - 1)
+    lower = np.floor(positions).astype(int)
+    upper = np.minimum(lower + 1, len(samples) - 1)
+    partitioned = np.partition(samples, np.unique(np.concatenate([lower, upper])), axis=0)
+    weights = (positions - lower).reshape((-1,) + (1,) * (samples.ndim - 1))
+    return partitioned[lower] + (partitioned[upper] - partitioned[lower]) * weights
+
+
+class UncertaintyScorer:
+    """
+    Uncertainty of the predictions of every word x color x response transition condition.
+    A timeline only contains the conditions of design_matrix.CONDITION_MATRIX, so predictions
+    are computed once per condition rather than once per trial, and trials get their
+    uncertainty by an index gather. Results are cached per set of posterior draws, keyed by
+    a hash of beta_samples, so scoring many timelines against the same posterior costs one
+    pass over the draws.
+    Parameters:
+    cache_size (int): Number of posterior draw sets whose scores are kept.
+    """
+
+    def __init__(self, cache_size=8):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def condition_uncertainty(self, beta_samples):
+        """
+        Width of the 95% credible interval of the predicted probability of every condition.
+        Parameters:
+        beta_samples (array-like): Array of sampled beta coefficients from the Bayesian model.
+        Returns:
+        array-like: Uncertainty of every condition code, shape (n_conditions,).
+        """
+        beta_samples = np.ascontiguousarray(beta_samples)
+        key = (beta_samples.shape, beta_samples.dtype.str, hashlib.blake2b(beta_samples.view(np.uint8)).hexdigest())
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        # Compute predicted probabilities of every condition using the sampled beta coefficients
+        predicted_probs = sigmoid(beta_samples @ design_matrix.CONDITION_MATRIX.T)
+
+        # Calculate uncertainty as the difference between upper and lower bounds of the credible interval
+        lower_bound, upper_bound = partition_quantiles(predicted_probs, [0.025, 0.975])
+        uncertainty = upper_bound - lower_bound
+
+        self._cache[key] = uncertainty
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return uncertainty
+
+    def trial_uncertainty(self, trials, beta_samples):
+        """
+        Uncertainty of every trial of a timeline.
+        Parameters:
+        trials (list, DataFrame or dict): Timeline, as accepted by design_matrix.encode.
+        beta_samples (array-like): Array of sampled beta coefficients from the Bayesian model.
+        Returns:
+        array-like: Uncertainty of every trial.
+        """
+        return self.condition_uncertainty(beta_samples)[design_matrix.trial_conditions(trials)]
+
+
+# Scorer shared by all callers, so repeated scoring against one posterior hits the cache
+SCORER = UncertaintyScorer()
+
+
 def sample_condition(df, beta_samples):
     """
     Sample the condition with the maximum uncertainty from the given DataFrame.
@@ -22,27 +104,72 @@ def sample_condition(df, beta_samples):
     Returns:
     int: Index of the condition with the maximum uncertainty.
     """
-    # Encode categorical variables
-    df_encoded = pd.get_dummies(df[['word', 'color', 'response_transition']], drop_first=True)
-    # Dependent variable (correct/incorrect)
-
-    # Independent variables (encoded), Prepare test data
-    X_test = df_encoded.values
-
-    # Compute logits for the test set using the sampled beta coefficients
-    logits_samples_test = np.dot(beta_samples, X_test.T)
-    # Compute predicted probabilities using the sigmoid function
-    predicted_probs_test = sigmoid(logits_samples_test)
-
-    # Calculate the mean and credible interval for the test predictions
-    mean_predicted_prob_test = np.mean(predicted_probs_test, axis=0)
-    lower_bound_test = np.percentile(predicted_probs_test, 2.5, axis=0)
-    upper_bound_test = np.percentile(predicted_probs_test, 97.5, axis=0)
-
-    # Calculate uncertainty as the difference between upper and lower bounds
-    uncertainty = upper_bound_test - lower_bound_test
+    # Uncertainty of every trial, gathered from the uncertainty of its condition
+    uncertainty = SCORER.trial_uncertainty(df, beta_samples)
     print(f"Uncertainty: {uncertainty}")
     # Find the index of the condition with the maximum uncertainty
     max_uncertainty = np.argmax(uncertainty)
 
     return max_uncertainty
+
+
+def condition_counts(timelines):
+    """
+    Count the trials of every condition in every timeline.
+    Parameters:
+    timelines (list): Timelines as lists of trial dictionaries.
+    Returns:
+    array-like: Counts of shape (n_timelines, n_conditions).
+    Raises:
+    ValueError: If a trial has a level outside the design, as in design_matrix.encode_conditions.
+    """
+    lengths = [len(timeline) for timeline in timelines]
+    trials = [trial for timeline in timelines for trial in timeline]
+    codes = design_matrix.trial_conditions(trials).astype(np.int64)
+    if np.any(codes < 0):
+        raise ValueError(f'{np.sum(codes < 0)} trials have levels outside the design')
+    n_conditions = len(design_matrix.CONDITION_MATRIX)
+
+    # Offset the codes of every timeline so one bincount counts all timelines at once
+    offsets = np.repeat(np.arange(len(timelines)) * n_conditions, lengths)
+    counts = np.bincount(offsets + codes, minlength=len(timelines) * n_conditions)
+    return counts.reshape((len(timelines), n_conditions))
+
+
+def score_timelines(timelines, beta_samples, method='sum', weights=None):
+    """
+    Score candidate timelines by the uncertainty of the conditions they contain.
+    Parameters:
+    timelines (list): Candidate timelines as lists of trial dictionaries.
+    beta_samples (array-like): Array of sampled beta coefficients from the Bayesian model.
+    method (str): 'sum' for the summed uncertainty of all trials, 'count' for the number of
+        trials of the condition with the maximum uncertainty.
+    weights (array-like, optional): Weight of every condition, used instead of method.
+    Returns:
+    array-like: Score of every timeline.
+    """
+    if weights is None:
+        uncertainty = SCORER.condition_uncertainty(beta_samples)
+        if method == 'sum':
+            weights = uncertainty
+        elif method == 'count':
+            weights = np.arange(len(uncertainty)) == np.argmax(uncertainty)
+        else:
+            raise ValueError(f"Unknown scoring method: {method}")
+    return condition_counts(timelines) @ np.asarray(weights, dtype=float)
+
+
+@instrumentation.traced('acquisition')
+def select_timeline(timelines, beta_samples, method='sum', weights=None):
+    """
+    Select the candidate timeline with the highest score.
+    Parameters:
+    timelines (list): Candidate timelines as lists of trial dictionaries.
+    beta_samples (array-like): Array of sampled beta coefficients from the Bayesian model.
+    method (str): Scoring method, see score_timelines.
+    weights (array-like, optional): Weight of every condition, used instead of method.
+    Returns:
+    int: Index of the best timeline.
+    """
+    instrumentation.count('acquisition.candidates', len(timelines))
+    return int(np.argmax(score_timelines(timelines, beta_samples, method, weights)))
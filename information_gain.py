@@ -0,0 +1,154 @@
+import math
+import time
+
+import numpy as np
+
+import design_matrix
+import experimentalist
+import instrumentation
+
+
+def digamma(x):
+    """
+    Digamma function for positive arguments (asymptotic series after shifting the argument above 6).
+    """
+    x = np.array(x, dtype=float)
+    result = np.zeros_like(x)
+    # Shift with psi(x) = psi(x + 1) - 1 / x
+    while np.any(x < 6):
+        small = x < 6
+        result -= np.where(small, 1 / x, 0)
+        x = np.where(small, x + 1, x)
+    inverse_square = 1 / x ** 2
+    return result + np.log(x) - 0.5 / x - inverse_square * (
+        1 / 12 - inverse_square * (1 / 120 - inverse_square / 252))
+
+
+def normal_inverse_gamma_entropy(log_det_precision, a, b, n_params):
+    """
+    Joint entropy of beta and sigma2 under a Normal-Inverse-Gamma distribution, in nats.
+    Parameters:
+    log_det_precision (array-like): Log-determinant of the precision of beta (in units of sigma2).
+    a (array-like): Shape of sigma2.
+    b (array-like): Scale of sigma2.
+    n_params (int): Number of regression coefficients.
+    Returns:
+    array-like: Entropy, broadcast over the inputs.
+    """
+    a = np.asarray(a, dtype=float)
+    psi = digamma(a)
+    log_gamma = np.vectorize(math.lgamma)(a)
+    sigma2_entropy = a + np.log(b) + log_gamma - (1 + a) * psi
+    # beta | sigma2 is normal; E[log sigma2] = log b - psi(a)
+    beta_entropy = 0.5 * n_params * (np.log(2 * np.pi * np.e) + np.log(b) - psi) - 0.5 * log_det_precision
+    return sigma2_entropy + beta_entropy
+
+
+def expected_posterior_entropy(counts, posterior, beta_samples, sigma2_samples, rng):
+    """
+    Monte-Carlo estimate of the entropy of the posterior after running each candidate.
+    The outcomes of every candidate are simulated under every posterior draw through their
+    sufficient statistics: per condition, the mean RT of its c trials is N(x @ beta, sigma2 / c)
+    and the within-condition sum of squares is sigma2 * chi2(c - 1). Only the scale b of the
+    updated posterior depends on the outcomes, so everything else is computed once per candidate.
+    Parameters:
+    counts (array-like): Trials per condition of every candidate, shape (n_candidates, n_conditions).
+    posterior (PosteriorState): Current posterior.
+    beta_samples (array-like): Posterior draws of beta, shape (n_draws, n_params).
+    sigma2_samples (array-like): Posterior draws of sigma2, shape (n_draws,).
+    rng (Generator): Random generator.
+    Returns:
+    array-like: Expected posterior entropy of every candidate, shape (n_candidates,).
+    """
+    features = design_matrix.CONDITION_MATRIX
+    n_params = features.shape[1]
+    counts = np.asarray(counts, dtype=float)
+
+    # Outcome-independent parts: updated precision, its inverse and the updated shape
+    precision = posterior.precision + np.einsum('tk,kp,kq->tpq', counts, features, features)
+    covariance = np.linalg.inv(precision)
+    _, log_det_precision = np.linalg.slogdet(precision)
+    a = posterior.a + counts.sum(axis=1) / 2
+    prior_term = posterior.mean @ posterior.precision @ posterior.mean
+
+    # Simulate the sufficient statistics of the outcomes, shape (n_candidates, n_draws, n_conditions)
+    sigma2 = np.asarray(sigma2_samples)[None, :, None]
+    means = (beta_samples @ features.T)[None] + np.sqrt(sigma2 / np.maximum(counts, 1)[:, None]) * \
+        rng.standard_normal((len(counts), len(sigma2_samples), len(features)))
+    within = sigma2 * rng.chisquare(np.maximum(counts - 1, 1e-12)[:, None], size=means.shape) * (counts > 1)[:, None]
+    Xty = np.einsum('tsk,kp->tsp', counts[:, None] * means, features)
+    yty = np.sum(counts[:, None] * means ** 2 + within, axis=2)
+
+    # Updated scale: b + (yty + mu0' L0 mu0 - mu_n' L_n mu_n) / 2, with L_n mu_n = L0 mu0 + X'y
+    rhs = (posterior.precision @ posterior.mean)[None, None] + Xty
+    updated_mean = np.einsum('tpq,tsq->tsp', covariance, rhs)
+    b = posterior.b + 0.5 * (yty + prior_term - np.einsum('tsp,tsp->ts', updated_mean, rhs))
+
+    entropy = normal_inverse_gamma_entropy(log_det_precision[:, None], a[:, None], b, n_params)
+    return np.mean(entropy, axis=1)
+
+
+def expected_information_gain(counts, posterior, beta_samples=None, sigma2_samples=None, max_draws=2000,
+                              batch_draws=64, time_budget=None, rng=None):
+    """
+    Expected reduction of the joint entropy of beta and sigma2 from running each candidate.
+    Draws are processed in batches and the estimate is refined until max_draws draws were used
+    or time_budget seconds have passed; the first batch is always completed, so every
+    candidate gets an estimate.
+    Parameters:
+    counts (array-like): Trials per condition of every candidate, shape (n_candidates, n_conditions).
+    posterior (PosteriorState): Current posterior, e.g. PosteriorState.from_samples of run_theory's draws.
+    beta_samples, sigma2_samples (array-like, optional): Posterior draws to simulate from; drawn from posterior if None.
+    max_draws (int): Maximum number of posterior draws.
+    batch_draws (int): Number of draws per batch.
+    time_budget (float, optional): Seconds after which no further batch is started.
+    rng (int or Generator, optional): Seed or random generator.
+    Returns:
+    array-like: Expected information gain of every candidate, in nats.
+    """
+    rng = np.random.default_rng(rng)
+    started = time.monotonic()
+    n_params = len(posterior.mean)
+    current_entropy = normal_inverse_gamma_entropy(
+        np.linalg.slogdet(posterior.precision)[1], posterior.a, posterior.b, n_params)
+
+    total, n_draws = 0, 0
+    while n_draws < max_draws:
+        size = min(batch_draws, max_draws - n_draws)
+        if beta_samples is None:
+            beta, sigma2 = posterior.sample(size, rng)
+        else:
+            draws = rng.integers(0, len(beta_samples), size)
+            beta, sigma2 = np.asarray(beta_samples)[draws], np.asarray(sigma2_samples)[draws]
+        total = total + size * expected_posterior_entropy(counts, posterior, beta, sigma2, rng)
+        n_draws += size
+        if time_budget is not None and time.monotonic() - started > time_budget:
+            break
+    instrumentation.count('acquisition.draws', n_draws)
+    return current_entropy - total / n_draws
+
+
+def condition_information_gain(posterior, n_trials=1, **kwargs):
+    """
+    Expected information gain of running n_trials trials of every single condition.
+    Returns:
+    array-like: Expected information gain of every condition code.
+    """
+    counts = n_trials * np.eye(len(design_matrix.CONDITION_MATRIX))
+    return expected_information_gain(counts, posterior, **kwargs)
+
+
+@instrumentation.traced('acquisition')
+def select_timeline(timelines, posterior, **kwargs):
+    """
+    Select the candidate timeline with the largest expected information gain.
+    Parameters:
+    timelines (list): Candidate timelines as lists of trial dictionaries.
+    posterior (PosteriorState): Current posterior.
+    kwargs: Options of expected_information_gain, e.g. time_budget.
+    Returns:
+    int: Index of the best timeline.
+    """
+    instrumentation.count('acquisition.candidates', len(timelines))
+    gain = expected_information_gain(experimentalist.condition_counts(timelines), posterior, **kwargs)
+    return int(np.argmax(gain))
@@ -0,0 +1,186 @@
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+# Recording state; everything below is a no-op until enable is called
+_enabled = False
+_lock = threading.Lock()
+_origin = time.perf_counter()
+_spans = []
+_counters = defaultdict(float)
+_values = defaultdict(list)
+
+
+class Span:
+    """
+    Timed section of a run, recorded when the with-block exits.
+    Attributes can be added while the span is open with set, e.g. the number of trials parsed.
+    """
+    __slots__ = ('name', 'attributes', 'start')
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.start = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter()
+        with _lock:
+            _spans.append((self.name, self.start - _origin, end - self.start, os.getpid(), threading.get_ident(),
+                           self.attributes))
+        return False
+
+
+class NullSpan:
+    """
+    Span returned while recording is disabled; it does nothing.
+    """
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def enable():
+    """
+    Start recording spans, counters and values, discarding earlier records.
+    """
+    global _enabled, _origin
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        _values.clear()
+        _origin = time.perf_counter()
+    _enabled = True
+
+
+def disable():
+    """
+    Stop recording; the records so far are kept for export and summary.
+    """
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+def span(name, **attributes):
+    """
+    Context manager timing a stage, e.g. with span('theorist', backend='mh'): ...
+    """
+    if not _enabled:
+        return NULL_SPAN
+    return Span(name, attributes)
+
+
+def traced(name):
+    """
+    Decorator recording every call of a function as a span.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with Span(name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    """
+    Add value to a counter, e.g. count('theorist.samples', 5000).
+    """
+    if _enabled:
+        with _lock:
+            _counters[name] += value
+
+
+def record(name, value):
+    """
+    Record one observation of a value, e.g. record('theorist.acceptance_rate', 0.23).
+    """
+    if _enabled:
+        with _lock:
+            _values[name].append(float(value))
+
+
+def trace_events():
+    """
+    Records in the Chrome trace event format (complete events for spans, counter events for counters).
+    """
+    events = [{'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6, 'pid': pid, 'tid': tid,
+               'args': attributes} for name, start, duration, pid, tid, attributes in _spans]
+    end = max([event['ts'] + event['dur'] for event in events], default=0)
+    events += [{'name': name, 'ph': 'C', 'ts': end, 'pid': os.getpid(), 'args': {name: value}}
+               for name, value in _counters.items()]
+    return events
+
+
+def export(path):
+    """
+    Write the records to path: JSON lines (one event per line) if path ends in .jsonl, otherwise a
+    Chrome trace viewable in chrome://tracing or Perfetto.
+    """
+    with _lock:
+        events = trace_events()
+        values = {name: list(observations) for name, observations in _values.items()}
+    with open(path, 'w') as file:
+        if path.endswith('.jsonl'):
+            for event in events:
+                file.write(json.dumps(event) + '\n')
+            for name, observations in values.items():
+                file.write(json.dumps({'name': name, 'ph': 'values', 'values': observations}) + '\n')
+        else:
+            json.dump({'traceEvents': events, 'otherData': {'values': values}}, file)
+
+
+def summary():
+    """
+    Text report of the time per stage, the counters and the recorded values.
+    Counters named '<stage>.<quantity>' are also reported per second of their stage.
+    Returns:
+    str: The report.
+    """
+    with _lock:
+        totals = defaultdict(lambda: [0, 0.0, 0.0])
+        for name, _, duration, _, _, _ in _spans:
+            stats = totals[name]
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+        counters = dict(_counters)
+        values = {name: list(observations) for name, observations in _values.items()}
+
+    lines = [f"{'stage':<24}{'calls':>8}{'total s':>12}{'mean s':>12}{'max s':>12}"]
+    for name, (calls, total, longest) in sorted(totals.items(), key=lambda item: -item[1][1]):
+        lines.append(f"{name:<24}{calls:>8}{total:>12.3f}{total / calls:>12.4f}{longest:>12.4f}")
+    for name, value in sorted(counters.items()):
+        stage = name.split('.')[0]
+        rate = f" ({value / totals[stage][1]:.1f}/s of {stage})" if stage in totals and totals[stage][1] > 0 else ''
+        lines.append(f"{name}: {value:g}{rate}")
+    for name, observations in sorted(values.items()):
+        lines.append(f"{name}: mean {sum(observations) / len(observations):.4g} over {len(observations)}")
+    return '\n'.join(lines)
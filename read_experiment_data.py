@@ -1,34 +1,232 @@
 import json
 import os
 import re
+import time
 
+import numpy as np
 import pandas as pd
 
+import instrumentation
 
-def read_experiment_data():
-    #  Load the JSON file
-    file_name = 'experimentData.json'
+# Default location of the results file, downloaded by the browser at the end of the experiment
+RESULTS_PATH = os.path.join(os.path.expanduser('~/Downloads'), 'experimentData.json')
 
-    # Construct the full path to the file in the Downloads folder
-    downloads_folder = os.path.expanduser('~/Downloads')
-    file_path = os.path.join(downloads_folder, file_name)
+# Values filled in when the participant did not respond in time
+RT_FILL = 3000
+RESPONSE_FILL = 'j'
+
+# Whitespace and punctuation between the sessions or records of a results file
+SEPARATORS = re.compile(r'[\s,\]]*')
+# End of a top-level array followed by the start of the next one
+SESSION_END = re.compile(r'\][\s,]*\[')
+
+
+def wait_for_experiment_data(file_path=None, timeout=1800, poll_interval=0.2, settle_time=0.5, newer_than=None):
+    """
+    Wait until a complete results file is available and return as soon as it is.
+    The file counts as complete once its size and modification time have not changed for
+    settle_time seconds and it parses as JSON, so a download that is still being written
+    is never picked up.
+    Parameters:
+    file_path (str, optional): Results file to watch, RESULTS_PATH by default.
+    timeout (float): Maximum number of seconds to wait.
+    poll_interval (float): Seconds between checks of the file.
+    settle_time (float): Seconds the file has to stay unchanged.
+    newer_than (float, optional): Ignore files last modified before this time.time() timestamp.
+    Returns:
+    str: Path of the complete results file.
+    """
+    file_path = file_path or RESULTS_PATH
+    deadline = time.monotonic() + timeout
+    signature, stable_since = None, None
+    while True:
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            stat = None
+
+        if stat is not None and (newer_than is None or stat.st_mtime >= newer_than):
+            if (stat.st_size, stat.st_mtime_ns) != signature:
+                signature, stable_since = (stat.st_size, stat.st_mtime_ns), time.monotonic()
+            elif time.monotonic() - stable_since >= settle_time:
+                try:
+                    with open(file_path, 'r') as file:
+                        json.load(file)
+                    return file_path
+                except json.JSONDecodeError:
+                    # Partially written file, wait for the next change
+                    signature = None
+
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"No complete results file at {file_path} after {timeout} seconds")
+        time.sleep(poll_interval)
+
+
+def read_experiment_data(file_path=None):
+    #  Load the JSON file from the Downloads folder unless another results file is given
+    file_path = file_path or RESULTS_PATH
 
     with open(file_path, 'r') as file:
         data = json.load(file)
 
-    # Define the regex pattern to match ">red<" or ">green<"
-    pattern = re.compile(r'>red</div>|>green</div>')
+    return filter_experiment_data(data)
+
+
+def filter_experiment_data(data):
+    """
+    Extract the Stroop trials of one session from its jsPsych records.
+    Parameters:
+    data (list): jsPsych trial records, as loaded from the results file or posted to the experiment server.
+    Returns:
+    DataFrame: rt, response, word and color of the Stroop trials, in the order of the timeline.
+    Raises:
+    ValueError: If data is not a list of records.
+    """
+    if not isinstance(data, list) or not all(isinstance(record, dict) for record in data):
+        raise ValueError('Results must be a list of jsPsych trial records')
+    columns = experiment_columns((0, record) for record in data)
+    return pd.DataFrame({name: columns[name] for name in ['rt', 'response', 'word', 'color']})
+
+
+def check_timeline(timeline, results, source='the results'):
+    """
+    Check that the Stroop trials of a session are those of the timeline it was run from: one
+    per timeline row, in timeline order, with the same word and color.
+    Parameters:
+    timeline (list): Trial dictionaries of the timeline.
+    results (DataFrame or dict): word and color of every Stroop trial, e.g. from filter_experiment_data.
+    source (str): Description of the results used in the error message.
+    Raises:
+    ValueError: If the number of trials, or the word or color of any trial, differs.
+    """
+    if len(results['word']) != len(timeline):
+        raise ValueError(f'{source}: {len(results["word"])} trials, but {len(timeline)} in the timeline')
+    mismatch = (np.array([trial['word'] for trial in timeline]) != np.asarray(results['word'])) | \
+        (np.array([trial['color'] for trial in timeline]) != np.asarray(results['color']))
+    if np.any(mismatch):
+        raise ValueError(f'{source}: {np.sum(mismatch)} trials do not match the timeline')
+
+
+def iter_records(file, chunk_size=1 << 20):
+    """
+    Incrementally decode the jsPsych records of a results file.
+    The file may hold one JSON array of records, several arrays written one after the other
+    (e.g. appended sessions) or one record per line. Every top-level array is decoded in one
+    call of the C decoder, and only JSON-lines input is decoded record by record, so memory
+    is bounded by the largest session rather than by the size of the file.
+    Parameters:
+    file (file object): Results file opened in text mode.
+    chunk_size (int): Number of characters read at a time.
+    Yields:
+    tuple: Session number (counting the top-level arrays from 0) and record dictionary.
+    """
+    decoder = json.JSONDecoder()
+    buffer, position = '', 0
+    n_arrays = 0
+    end_of_file = False
+    while True:
+        position = SEPARATORS.match(buffer, position).end()
+        if position < len(buffer):
+            try:
+                value, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # A value cut by the end of the buffer, unless the file is exhausted
+                if end_of_file:
+                    raise
+            else:
+                if isinstance(value, list):
+                    n_arrays += 1
+                    for record in value:
+                        yield n_arrays - 1, record
+                else:
+                    yield max(n_arrays - 1, 0), value
+                continue
+        elif end_of_file:
+            return
+
+        # Decoding a session again is as costly as decoding it, so the chunks after a cut session
+        # are collected until one may hold its end; a cut record of JSON lines is retried right away
+        chunks = [buffer[position:]]
+        while True:
+            chunk = file.read(chunk_size)
+            end_of_file = not chunk
+            chunks.append(chunk)
+            if end_of_file or chunks[0][:1] != '[' or SESSION_END.search(chunks[-2][-1024:] + chunk):
+                break
+        buffer, position = ''.join(chunks), 0
+
+
+@instrumentation.traced('ingest')
+def experiment_columns(records):
+    """
+    Collect the Stroop trials of a stream of records into typed columns.
+    Stroop trials are the records with a non-empty bean_correct_key, and their word and color
+    are taken from the bean_text and bean_color fields written by sweetbean. Trials are ordered
+    by session and trial_index, and numbered within their session, so trial is the row of the
+    timeline the trial was generated from.
+    Parameters:
+    records (iterable): (session, record) pairs, as yielded by iter_records.
+    Returns:
+    dict: Arrays session, trial, trial_index (int), word, color, response (str), rt (float) and correct (bool).
+    """
+    sessions, trial_indices, words, colors, rts, responses, correct = [], [], [], [], [], [], []
+    for session, record in records:
+        if not record.get('bean_correct_key'):
+            continue
+        sessions.append(session)
+        trial_indices.append(record.get('trial_index', len(trial_indices)))
+        words.append(record['bean_text'])
+        colors.append(record['bean_color'])
+        rts.append(record.get('rt'))
+        responses.append(record.get('response'))
+        correct.append(bool(record.get('bean_correct')))
+
+    session = np.array(sessions, dtype=np.int32)
+    trial_index = np.array(trial_indices, dtype=np.int32)
+    order = np.lexsort((trial_index, session))
+    session, trial_index = session[order], trial_index[order]
 
-    # Filter the rows based on the regex pattern
-    filtered_data = [row for row in data if pattern.search(row['stimulus'])]
+    # Number the trials within their session
+    starts = np.flatnonzero(np.diff(session, prepend=-1))
+    trial = np.arange(len(session), dtype=np.int32) - np.repeat(starts, np.diff(np.append(starts, len(session))))
 
-    filtered_df = pd.DataFrame(filtered_data)
+    # Missed responses get the same fill values as the original DataFrame path
+    rt = np.array([RT_FILL if value is None else value for value in rts], dtype=np.float64)
+    response = np.array([RESPONSE_FILL if value is None else value for value in responses], dtype=str)
+    instrumentation.count('ingest.trials', len(session))
+    return {
+        'session': session,
+        'trial': trial.astype(np.int32),
+        'trial_index': trial_index,
+        'word': np.array(words, dtype=str)[order],
+        'color': np.array(colors, dtype=str)[order],
+        'rt': rt[order],
+        'response': response[order],
+        'correct': np.array(correct, dtype=bool)[order],
+    }
 
-    columns = ['rt', 'response', 'stimulus']
 
-    filtered_df = filtered_df[columns]
+def read_experiment_columns(file_paths=None, chunk_size=1 << 20):
+    """
+    Stream one or more results files into typed columns of their Stroop trials.
+    Sessions are numbered consecutively across the files, in the order given.
+    Parameters:
+    file_paths (str or list, optional): Results file(s), RESULTS_PATH by default.
+    chunk_size (int): Number of characters read at a time.
+    Returns:
+    dict: Columns of the Stroop trials, as returned by experiment_columns.
+    """
+    if file_paths is None or isinstance(file_paths, (str, os.PathLike)):
+        file_paths = [file_paths or RESULTS_PATH]
 
-    filtered_df['rt'] = filtered_df['rt'].fillna(3000)
-    filtered_df['response'] = filtered_df['response'].fillna('j')
+    def records():
+        n_sessions = 0
+        for file_path in file_paths:
+            n_file_sessions = 0
+            with open(file_path, 'r') as file:
+                for session, record in iter_records(file, chunk_size):
+                    n_file_sessions = session + 1
+                    yield n_sessions + session, record
+            n_sessions += n_file_sessions
 
-    return filtered_df
+    return experiment_columns(records())
@@ -0,0 +1,166 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import design_matrix
+import read_experiment_data
+import theorist
+
+# Files of an archived session: the downloaded or posted results and the timeline that was run
+DATA_FILE = 'experimentData.json'
+TIMELINE_FILE = 'timeline.json'
+
+
+def find_sessions(directory):
+    """
+    Find the archived sessions below a directory. A session is a directory holding the results
+    file DATA_FILE next to the timeline TIMELINE_FILE it was generated from.
+    Returns:
+    list: (data path, timeline path) of every session, sorted by path.
+    """
+    sessions = []
+    for root, _, files in os.walk(directory):
+        if DATA_FILE in files and TIMELINE_FILE in files:
+            sessions.append((os.path.join(root, DATA_FILE), os.path.join(root, TIMELINE_FILE)))
+    return sorted(sessions)
+
+
+def load_session(data_path, timeline_path):
+    """
+    Parse an archived session and encode it for the theorist.
+    The Stroop trials have to match the timeline trial by trial (see
+    read_experiment_data.check_timeline); the response transition is taken from the timeline.
+    Returns:
+    tuple: Design matrix X (n_trials, n_features) and reaction times y (n_trials,).
+    """
+    columns = read_experiment_data.read_experiment_columns(data_path)
+    with open(timeline_path, 'r') as file:
+        timeline = json.load(file)
+    if np.any(columns['session'] != 0):
+        raise ValueError(f'{data_path} holds more than one session')
+    read_experiment_data.check_timeline(timeline, columns, data_path)
+    return design_matrix.encode(timeline), columns['rt']
+
+
+def summarize(beta_samples, sigma2_samples):
+    """
+    Posterior summary of a fit: mean, standard deviation and 95% interval of every coefficient,
+    keyed by design_matrix.FEATURE_NAMES, and the posterior mean of sigma2.
+    """
+    lower, upper = np.percentile(beta_samples, [2.5, 97.5], axis=0)
+    return {
+        'beta': {name: {'mean': float(mean), 'sd': float(sd), 'lower': float(low), 'upper': float(high)}
+                 for name, mean, sd, low, high in zip(design_matrix.FEATURE_NAMES, np.mean(beta_samples, axis=0),
+                                                      np.std(beta_samples, axis=0), lower, upper)},
+        'sigma2': float(np.mean(sigma2_samples)),
+    }
+
+
+def fit(X, y, n_samples, seed, backend='conjugate', step_size=0.05, **options):
+    """
+    Fit the RT model to one block of trials with run_theory from the weak initial prior.
+    Parameters:
+    X (array-like): Design matrix.
+    y (array-like): Reaction times.
+    n_samples (int): Number of posterior samples.
+    seed (SeedSequence or int): Seed of the sampler.
+    backend (str): Backend of run_theory; the exact conjugate posterior by default.
+    step_size (float): Proposal or initial leapfrog step size of the MCMC backends.
+    options: Further options of theorist.run_theory, e.g. n_chains or adaptive.
+    Returns:
+    dict: Posterior summary, as returned by summarize, with the number of trials and the fitting time.
+    """
+    started = time.perf_counter()
+    # run_theory reports its progress on stdout, which would interleave across the workers
+    with contextlib.redirect_stdout(io.StringIO()):
+        beta_samples, sigma2_samples = theorist.run_theory('initial', None, None, n_samples, step_size, X, y,
+                                                           rng=np.random.default_rng(seed), backend=backend, **options)
+    return dict(summarize(beta_samples, sigma2_samples), n_trials=len(y), seconds=time.perf_counter() - started)
+
+
+def replay_session(data_path, timeline_path, n_samples, seed, **options):
+    """
+    Parse, encode and re-fit one archived session; the work unit of replay.
+    Returns:
+    dict: Path of the session, its design matrix X and reaction times y, and its fit, or the error
+    that made the session unusable.
+    """
+    result = {'session': os.path.dirname(data_path)}
+    try:
+        X, y = load_session(data_path, timeline_path)
+    except (OSError, ValueError, KeyError) as error:
+        return dict(result, error=f'{type(error).__name__}: {error}')
+    return dict(result, X=X, y=y, fit=fit(X, y, n_samples, seed, **options))
+
+
+def replay(directory, n_samples=5000, seed=None, max_workers=None, pooled=True, **options):
+    """
+    Re-fit every archived session below a directory, one session per task of a process pool,
+    and the pooled trials of all sessions.
+    Parameters:
+    directory (str): Directory of the archived sessions, see find_sessions.
+    n_samples (int): Number of posterior samples per fit.
+    seed (int, optional): Seed from which independent streams of all fits are spawned.
+    max_workers (int, optional): Number of worker processes; all cores by default.
+    pooled (bool): Also fit all trials of all usable sessions together.
+    options: Options of fit, e.g. backend='mh' and n_chains.
+    Returns:
+    dict: Per-session fits ('sessions', in the order of find_sessions) and the pooled fit ('pooled').
+    """
+    sessions = find_sessions(directory)
+    seeds = np.random.SeedSequence(seed).spawn(len(sessions) + 1)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(replay_session, data_path, timeline_path, n_samples, session_seed, **options)
+                   for (data_path, timeline_path), session_seed in zip(sessions, seeds)]
+        results = [future.result() for future in futures]
+
+    usable = [result for result in results if 'error' not in result]
+    for result in results:
+        if 'error' in result:
+            print(f"Skipped {result['session']}: {result['error']}", file=sys.stderr)
+    report = {'sessions': [{key: value for key, value in result.items() if key not in ('X', 'y')}
+                           for result in results], 'pooled': None}
+    if pooled and usable:
+        X = np.concatenate([result['X'] for result in usable])
+        y = np.concatenate([result['y'] for result in usable])
+        report['pooled'] = dict(fit(X, y, n_samples, seeds[-1], **options), n_sessions=len(usable))
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Re-fit the RT model to archived sessions, per session and pooled.')
+    parser.add_argument('directory', help='directory of the archived sessions')
+    parser.add_argument('--backend', choices=['conjugate', 'mh', 'hmc'], default='conjugate',
+                        help='fitting backend of run_theory (default: conjugate)')
+    parser.add_argument('--adaptive', action='store_true', help='use adaptive Metropolis-Hastings')
+    parser.add_argument('--samples', type=int, default=5000, help='posterior samples per fit')
+    parser.add_argument('--chains', type=int, default=4, help='chains per MCMC fit')
+    parser.add_argument('--seed', type=int, default=0, help='seed of all fits')
+    parser.add_argument('--workers', type=int, help='worker processes (default: all cores)')
+    parser.add_argument('--no-pooled', action='store_true', help='skip the fit of the pooled sessions')
+    parser.add_argument('--output', help='file to write the JSON report to (default: stdout)')
+    args = parser.parse_args(argv)
+
+    options = {'backend': args.backend}
+    if args.backend != 'conjugate':
+        options.update(n_chains=args.chains, adaptive=args.adaptive)
+    report = replay(args.directory, args.samples, args.seed, args.workers, not args.no_pooled, **options)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text)
+    else:
+        print(text)
+    return report
+
+
+if __name__ == '__main__':
+    main()
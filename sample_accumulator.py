@@ -0,0 +1,171 @@
+import numpy as np
+
+
+class RunningMoments:
+    """
+    Running mean and variance of a stream of vectors (Welford's algorithm, merged batch-wise
+    with Chan's update so every call can add the draws of all chains at once).
+    Parameters:
+    n_dims (int): Length of the vectors.
+    """
+
+    def __init__(self, n_dims):
+        self.count = 0
+        self.mean = np.zeros(n_dims)
+        self.m2 = np.zeros(n_dims)
+
+    def update(self, batch):
+        """
+        Add a batch of vectors of shape (n_vectors, n_dims).
+        """
+        batch = np.asarray(batch, dtype=float)
+        n_batch = len(batch)
+        batch_mean = np.mean(batch, axis=0)
+        delta = batch_mean - self.mean
+        total = self.count + n_batch
+        self.mean = self.mean + delta * n_batch / total
+        self.m2 = self.m2 + np.sum((batch - batch_mean) ** 2, axis=0) + delta ** 2 * self.count * n_batch / total
+        self.count = total
+
+    @property
+    def variance(self):
+        """
+        Population variance of the vectors seen so far (as np.var).
+        """
+        return self.m2 / self.count
+
+
+class ReservoirSketch:
+    """
+    Fixed-size uniform random subsample of a stream of vectors, used to estimate quantiles
+    in constant memory.
+    Parameters:
+    n_dims (int): Length of the vectors.
+    size (int): Number of vectors kept.
+    dtype (dtype): Storage type of the kept vectors.
+    rng (int or Generator, optional): Seed or random generator.
+    """
+
+    def __init__(self, n_dims, size, dtype=np.float64, rng=None):
+        self.reservoir = np.zeros((size, n_dims), dtype=dtype)
+        self.count = 0
+        self.rng = np.random.default_rng(rng)
+
+    def update(self, batch):
+        """
+        Add a batch of vectors of shape (n_vectors, n_dims).
+        The replacements of Algorithm R are drawn for the whole batch at once: the vector at
+        stream position t replaces a random slot with probability size / (t + 1), and of several
+        vectors drawn into the same slot the last one is kept.
+        """
+        batch = np.asarray(batch)
+        size = len(self.reservoir)
+        n_fill = max(0, min(size - self.count, len(batch)))
+        self.reservoir[self.count:self.count + n_fill] = batch[:n_fill]
+        positions = self.count + np.arange(n_fill, len(batch))
+        slots = self.rng.integers(0, positions + 1)
+        replacing = np.flatnonzero(slots < size)
+        # Keep the last vector of every slot, as the sequential algorithm would
+        last_slots, last = np.unique(slots[replacing][::-1], return_index=True)
+        self.reservoir[last_slots] = batch[n_fill:][replacing[::-1][last]]
+        self.count += len(batch)
+
+    def quantile(self, q):
+        """
+        Estimate the q-quantile(s) of every dimension.
+        """
+        return np.quantile(self.reservoir[:min(self.count, len(self.reservoir))], q, axis=0)
+
+
+class SampleAccumulator:
+    """
+    Streaming sink for MCMC draws with burn-in, thinning and on-the-fly summaries.
+    Every call to add receives one step of all chains. After burn_in steps, every thin-th
+    step is folded into running means and variances and, optionally, into a reservoir
+    quantile sketch, so memory does not grow with the number of samples. Full draws are
+    only stored when keep_samples is set.
+    Parameters:
+    n_params (int): Number of regression coefficients.
+    burn_in (int): Number of initial steps that are discarded.
+    thin (int): Keep every thin-th step after burn-in.
+    dtype (dtype): Storage type of retained samples and of the sketch, e.g. np.float32.
+    keep_samples (bool): Also store every kept draw.
+    sketch_size (int, optional): Size of the quantile sketch; no sketch when None.
+    rng (int or Generator, optional): Seed or random generator of the sketch.
+    """
+
+    def __init__(self, n_params, burn_in=0, thin=1, dtype=np.float64, keep_samples=False, sketch_size=None,
+                 rng=None):
+        self.burn_in = burn_in
+        self.thin = thin
+        self.dtype = dtype
+        self.keep_samples = keep_samples
+        self.n_steps = 0
+        self.moments = RunningMoments(n_params + 1)
+        self.sketch = ReservoirSketch(n_params + 1, sketch_size, dtype, rng) if sketch_size else None
+        self._kept = []
+
+    def add(self, beta, sigma2):
+        """
+        Record one step of all chains: beta of shape (n_chains, n_params) and sigma2 of shape (n_chains,).
+        """
+        step = self.n_steps
+        self.n_steps += 1
+        if step < self.burn_in or (step - self.burn_in) % self.thin:
+            return
+        self.add_independent(beta, sigma2)
+
+    def add_independent(self, beta, sigma2):
+        """
+        Fold i.i.d. draws, e.g. from the exact conjugate posterior, into the summaries without
+        counting them as a step, so burn-in and thinning do not apply.
+        """
+        draws = np.concatenate([beta, np.asarray(sigma2)[:, None]], axis=1)
+        self.moments.update(draws)
+        if self.sketch is not None:
+            self.sketch.update(draws)
+        if self.keep_samples:
+            self._kept.append(draws.astype(self.dtype))
+
+    @property
+    def n_samples(self):
+        """
+        Number of draws folded into the summaries.
+        """
+        return self.moments.count
+
+    @property
+    def posterior_means(self):
+        return self.moments.mean[:-1]
+
+    @property
+    def posterior_variances(self):
+        return self.moments.variance[:-1]
+
+    @property
+    def sigma2_mean(self):
+        return self.moments.mean[-1]
+
+    @property
+    def sigma2_variance(self):
+        return self.moments.variance[-1]
+
+    def quantile(self, q):
+        """
+        Estimate quantiles of beta and sigma2 from the sketch.
+        Returns:
+        tuple: Quantiles of beta (..., n_params) and of sigma2 (...).
+        """
+        if self.sketch is None:
+            raise ValueError('quantiles need a sketch; create the accumulator with sketch_size')
+        quantiles = self.sketch.quantile(q)
+        return quantiles[..., :-1], quantiles[..., -1]
+
+    def samples(self):
+        """
+        Return the retained draws as (beta_samples, sigma2_samples), ordered step by step.
+        """
+        if not self.keep_samples:
+            raise ValueError('samples were not retained; create the accumulator with keep_samples=True')
+        draws = np.concatenate(self._kept) if self._kept else np.zeros((0, len(self.moments.mean)), self.dtype)
+        return draws[:, :-1], draws[:, -1]
@@ -0,0 +1,193 @@
+import asyncio
+import webbrowser
+
+import closed_loop
+import experiment_runner
+import experiment_server
+import read_experiment_data
+import theorist
+import trial_cache
+import trial_store
+
+
+class SessionScheduler:
+    """
+    Run participant sessions on several stations at once, all feeding one shared posterior.
+    Every station repeatedly takes a timeline, serves it through the experiment server and
+    waits for its results. Arriving blocks are merged into the shared PosteriorState under a
+    lock. The theorist refit and the experimentalist's choice of the next timeline then run
+    in worker threads, so stations never wait for each other or for the model. Refits
+    coalesce when several blocks arrive while one is running.
+    The first n_initial_sessions sessions, and any session started before the first refit
+    has finished, get an 'initial' timeline. Later sessions get a timeline chosen by
+    closed_loop.choose_timeline from the posterior of the latest refit, by expected
+    information gain as in the serial loop. A selection still running
+    when new samples arrive is kept; a finished one made from older samples is superseded
+    and its timeline returned to the pool. A session without results after session_timeout
+    seconds is abandoned and replaced by a new one, as is a session whose results cannot be
+    parsed or do not match its timeline. An error in a refit or selection stops the run and
+    is raised by run, which also closes the timeline pools when it returns.
+    Parameters:
+    n_stations (int): Number of sessions running in parallel.
+    n_sessions (int): Total number of sessions.
+    n_initial_sessions (int): Number of sessions run on 'initial' timelines.
+    n_samples (int): Number of posterior samples drawn per refit.
+    n_candidates (int): Candidate timelines the experimentalist chooses from.
+    server (ExperimentServer, optional): Server to run the sessions on; a new one on a free port by default.
+    open_browser (bool): Open every session page in the local browser; otherwise only print its URL.
+    store (TrialStore, optional): Store receiving every session's trials; the default store by default.
+    session_timeout (float): Seconds a station waits for the results of a session.
+    """
+
+    def __init__(self, n_stations=3, n_sessions=15, n_initial_sessions=2, n_samples=5000, n_candidates=100,
+                 server=None, open_browser=True, store=None, session_timeout=1800):
+        self.n_stations = n_stations
+        self.n_sessions = n_sessions
+        self.n_initial_sessions = n_initial_sessions
+        self.n_samples = n_samples
+        self.n_candidates = n_candidates
+        self.server = server or experiment_server.ExperimentServer()
+        self.open_browser = open_browser
+        self.store = store or trial_store.TrialStore()
+        self.session_timeout = session_timeout
+        self.initial_pool = trial_cache.TrialPool('initial')
+        self.update_pool = trial_cache.TrialPool('update', target_size=200, parallel=True)
+        self.posterior = None
+        self.beta_samples = None
+        self._snapshot = None
+        self.n_blocks = 0
+        self._sessions_started = 0
+        self._next_index = 0
+        self._lock = None
+        self._refit_needed = None
+        self._selection = None
+
+    async def run(self):
+        """
+        Start the server, run all sessions and return the final posterior.
+        Returns:
+        PosteriorState: The posterior after every block has been absorbed.
+        """
+        self._lock = asyncio.Lock()
+        self._refit_needed = asyncio.Event()
+        await self.server.start()
+        refit_task = asyncio.ensure_future(self._refit_loop())
+        stations = asyncio.gather(*(self._station(station) for station in range(self.n_stations)))
+        try:
+            # The refit loop only finishes by raising; stop the stations and surface its error then
+            await asyncio.wait([refit_task, stations], return_when=asyncio.FIRST_COMPLETED)
+            if refit_task.done():
+                stations.cancel()
+                refit_task.result()
+            await stations
+            await self._release_selection()
+        finally:
+            stations.cancel()
+            refit_task.cancel()
+            await self.server.stop()
+            # Closing waits for the shard being synthesized, so keep the event loop free meanwhile
+            loop = asyncio.get_running_loop()
+            for pool in (self.initial_pool, self.update_pool):
+                await loop.run_in_executor(None, pool.close)
+        return self.posterior
+
+    async def _station(self, station):
+        while self._sessions_started < self.n_sessions:
+            index = self._next_index
+            self._next_index += 1
+            self._sessions_started += 1
+            timeline = await self._next_timeline(index)
+
+            session_id = self.server.add_session(experiment_runner.render_page(timeline, experiment_runner.POST_DATA_JS))
+            print(f"Station {station}, session {index}: {self.server.url(session_id)}")
+            if self.open_browser:
+                webbrowser.open(self.server.url(session_id))
+
+            try:
+                data = await self.server.results(session_id, self.session_timeout)
+            except asyncio.TimeoutError:
+                # Abandoned page: drop the session and let a new one take its place
+                print(f"Station {station}, session {index}: no results after {self.session_timeout} s, abandoned")
+                self._sessions_started -= 1
+                continue
+            finally:
+                self.server.close_session(session_id)
+            try:
+                filtered_df = read_experiment_data.filter_experiment_data(data)
+                # Encoding checks the results against the timeline, so only matching results are stored
+                X_train, y_train = closed_loop.encode_results(timeline, filtered_df)
+            except (ValueError, KeyError, TypeError) as error:
+                # Malformed upload: drop the session without stopping the other stations
+                print(f"Station {station}, session {index}: unusable results, dropped "
+                      f"({type(error).__name__}: {error})")
+                self._sessions_started -= 1
+                continue
+            self.store.append(timeline, filtered_df, index, station=station)
+            await self.merge(X_train, y_train)
+
+    async def merge(self, X_train, y_train):
+        """
+        Absorb the encoded results of one session into the shared posterior and request a refit.
+        """
+        async with self._lock:
+            if self.posterior is None:
+                self.posterior = theorist.PosteriorState.initial(X_train.shape[1])
+            self.posterior.update(X_train, y_train)
+            self.n_blocks += 1
+        self._refit_needed.set()
+
+    async def _refit_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._refit_needed.wait()
+            self._refit_needed.clear()
+
+            # Sample from a snapshot, so blocks arriving meanwhile do not change the state being sampled
+            async with self._lock:
+                snapshot = theorist.PosteriorState(
+                    self.posterior.mean, self.posterior.precision, self.posterior.a, self.posterior.b)
+            beta_samples, _ = await loop.run_in_executor(None, snapshot.sample, self.n_samples)
+            self.beta_samples, self._snapshot = beta_samples, snapshot
+
+            # Start choosing the next timeline with the new samples
+            if self._sessions_started < self.n_sessions:
+                self._prepare_selection()
+
+    def _prepare_selection(self):
+        """
+        Start choosing the next timeline from the latest samples. A selection still running is
+        kept; a finished one from older samples is superseded and its timeline returned to the pool.
+        """
+        if self._selection is not None:
+            if not self._selection.done():
+                return
+            self.update_pool.add([self._selection.result()])
+        self._selection = self._select()
+
+    async def _release_selection(self):
+        """
+        Return the timeline of a selection prepared for a session that never started to the pool.
+        """
+        if self._selection is not None:
+            selection, self._selection = self._selection, None
+            self.update_pool.add([await selection])
+
+    def _select(self):
+        return asyncio.get_running_loop().run_in_executor(
+            None, closed_loop.choose_timeline, self.update_pool, self.beta_samples, self.n_candidates, self._snapshot)
+
+    async def _next_timeline(self, index):
+        loop = asyncio.get_running_loop()
+        if index < self.n_initial_sessions or self.beta_samples is None:
+            timelines = await loop.run_in_executor(None, self.initial_pool.take, 1)
+            return timelines[0]
+
+        # Use the selection prepared in the background and prepare one for the next station
+        selection = self._selection or self._select()
+        self._selection = self._select() if self._sessions_started < self.n_sessions else None
+        return await selection
+
+
+if __name__ == '__main__':
+    posterior = asyncio.run(SessionScheduler().run())
+    print(posterior.mean)
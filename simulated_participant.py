@@ -0,0 +1,187 @@
+import numpy as np
+
+import design_matrix
+import experiment_runner
+import read_experiment_data
+import theorist
+
+# Keys of the colors, as in the correct_response levels of experiment_runner
+KEYS = {color: color[0] for color in experiment_runner.COLORS}
+KEY_ARRAY = np.array([KEYS[color] for color in experiment_runner.COLORS])
+
+# Record of the instruction, fixation and feedback screens, which carry no correct key
+SCREEN_RECORD = {'trial_type': 'html-keyboard-response', 'bean_type': 'jsPsychHtmlKeyboardResponse',
+                 'bean_correct_key': ''}
+
+
+class SimulatedParticipant:
+    """
+    Headless participant answering Stroop timelines from a ground-truth model.
+    The mean RT of a trial is intercept + x @ beta for its design-matrix row x (see
+    design_matrix.FEATURE_NAMES), plus congruency_cost on incongruent trials. RTs are normal
+    with standard deviation sigma plus an exponential tail with mean tau; responses slower
+    than the stimulus duration are recorded as missed. Errors press the key of the word on
+    incongruent trials and a random other key on congruent ones.
+    All trials of all timelines are simulated in one vectorized pass, and session_records
+    returns jsPsych-shaped records that read_experiment_data consumes like a browser session.
+    The intercept and the congruency cost are not features of the fitted RT model, which has
+    no intercept column, so a fit does not recover beta unless both are 0. It converges to
+    model_beta instead, the projection of the true condition means onto the design matrix;
+    check_recovery compares a fit against it.
+    Parameters:
+    beta (array-like, optional): Ground-truth effects of the design-matrix features; zeros by default.
+    intercept (float): Mean RT of the baseline condition in ms.
+    congruency_cost (float): Additional RT of incongruent trials in ms.
+    sigma (float): Standard deviation of the normal RT component in ms.
+    tau (float): Mean of the exponential RT component in ms.
+    error_rate (float): Error probability on congruent trials.
+    incongruent_error_rate (float): Error probability on incongruent trials.
+    duration (float): Stimulus duration in ms after which the response is missed.
+    rng (int or Generator, optional): Seed or random generator.
+    """
+
+    def __init__(self, beta=None, intercept=600.0, congruency_cost=80.0, sigma=80.0, tau=0.0, error_rate=0.02,
+                 incongruent_error_rate=0.08, duration=2500.0, rng=None):
+        self.beta = np.zeros(len(design_matrix.FEATURE_NAMES)) if beta is None else np.asarray(beta, dtype=float)
+        self.intercept = intercept
+        self.congruency_cost = congruency_cost
+        self.sigma = sigma
+        self.tau = tau
+        self.error_rate = error_rate
+        self.incongruent_error_rate = incongruent_error_rate
+        self.duration = duration
+        self.rng = np.random.default_rng(rng)
+
+        # Congruency, mean RT, ink color and the key of the word of every condition code
+        words, colors, _ = np.meshgrid(experiment_runner.WORDS, experiment_runner.COLORS,
+                                       experiment_runner.RESPONSE_TRANSITIONS, indexing='ij')
+        self.incongruent = (words != colors).ravel()
+        self.color_index = np.array([experiment_runner.COLORS.index(color) for color in colors.ravel()])
+        self.word_keys = np.array([KEYS[word] for word in words.ravel()])
+        self.condition_means = intercept + design_matrix.CONDITION_MATRIX @ self.beta + \
+            congruency_cost * self.incongruent
+
+    def respond(self, timelines):
+        """
+        Simulate the responses to a batch of timelines.
+        Parameters:
+        timelines (list): Timelines as lists of trial dictionaries.
+        Returns:
+        tuple: RTs (float, NaN when missed) and pressed keys ('' when missed), one flat array over all trials.
+        """
+        trials = [trial for timeline in timelines for trial in timeline]
+        codes = design_matrix.trial_conditions(trials)
+        n_trials = len(codes)
+
+        rt = self.condition_means[codes] + self.sigma * self.rng.standard_normal(n_trials)
+        if self.tau > 0:
+            rt += self.rng.exponential(self.tau, n_trials)
+        rt = np.maximum(rt, 100.0)
+
+        # Correct key, replaced by an error key with the error rate of the trial's congruency
+        incongruent = self.incongruent[codes]
+        color_index = self.color_index[codes]
+        correct_keys = KEY_ARRAY[color_index]
+        other_keys = KEY_ARRAY[(color_index + self.rng.integers(1, len(KEY_ARRAY), n_trials)) % len(KEY_ARRAY)]
+        error = self.rng.random(n_trials) < np.where(incongruent, self.incongruent_error_rate, self.error_rate)
+        keys = np.where(error, np.where(incongruent, self.word_keys[codes], other_keys), correct_keys)
+
+        missed = rt > self.duration
+        return np.where(missed, np.nan, rt), np.where(missed, '', keys)
+
+    def session_records(self, timeline, rt=None, keys=None):
+        """
+        jsPsych-shaped records of one session: instructions, then fixation, Stroop and feedback
+        screens for every trial, then the final screen.
+        Parameters:
+        timeline (list): Trial dictionaries of the timeline.
+        rt, keys (array-like, optional): Responses from respond; simulated when None.
+        Returns:
+        list: Records as posted by the experiment page.
+        """
+        if rt is None:
+            rt, keys = self.respond([timeline])
+        records = [dict(SCREEN_RECORD, stimulus='instructions', bean_text='instructions', bean_color='white',
+                        rt=1000.0, response=' ') for _ in range(6)]
+        for trial, trial_rt, key in zip(timeline, rt.tolist(), keys.tolist()):
+            missed = key == ''
+            correct = key == KEYS[trial['color']]
+            records.append(dict(SCREEN_RECORD, stimulus='+', bean_text='+', bean_color='white', bean_duration=800,
+                                rt=None, response=None))
+            records.append(dict(SCREEN_RECORD, stimulus=f"<div style='color: {trial['color']}'>{trial['word']}</div>",
+                                bean_text=trial['word'], bean_color=trial['color'], bean_duration=self.duration,
+                                bean_correct_key=KEYS[trial['color']], bean_correct=correct,
+                                rt=None if missed else trial_rt, response=None if missed else key))
+            records.append(dict(SCREEN_RECORD, stimulus='feedback', bean_text='correct' if correct else 'false',
+                                bean_color='green' if correct else 'red', bean_duration=1000, rt=None, response=None))
+        records.append(dict(SCREEN_RECORD, stimulus='finish', bean_text='finish', bean_color='white',
+                            rt=1000.0, response=' '))
+
+        for index, record in enumerate(records):
+            record['trial_index'] = index
+        return records
+
+    def model_beta(self, timelines):
+        """
+        Coefficients the RT model converges to on sessions of these timelines: the least-squares
+        projection of the true condition means onto the design matrix, weighted by how often every
+        condition occurs. Equal to beta when intercept, congruency_cost and tau are 0. Misses
+        and the 100 ms floor of the RTs are ignored.
+        Returns:
+        array-like: Coefficients in the order of design_matrix.FEATURE_NAMES.
+        """
+        trials = [trial for timeline in timelines for trial in timeline]
+        counts = np.bincount(design_matrix.trial_conditions(trials), minlength=len(design_matrix.CONDITION_MATRIX))
+        weighted = design_matrix.CONDITION_MATRIX.T * counts
+        return np.linalg.solve(weighted @ design_matrix.CONDITION_MATRIX, weighted @ (self.condition_means + self.tau))
+
+    def check_recovery(self, timelines):
+        """
+        Simulate sessions of the timelines, parse and encode them as the closed loop does, fit the
+        conjugate posterior and compare its mean with model_beta.
+        Returns:
+        dict: Posterior mean ('fitted'), posterior standard deviation ('sd'), model_beta ('target')
+        and the z-score of the difference ('z') of every coefficient.
+        """
+        posterior = theorist.PosteriorState.initial(len(design_matrix.FEATURE_NAMES))
+        for timeline, records in zip(timelines, self.run_sessions(timelines)):
+            results = read_experiment_data.filter_experiment_data(records)
+            read_experiment_data.check_timeline(timeline, results)
+            posterior.update(design_matrix.encode(timeline), results['rt'].values)
+        target = self.model_beta(timelines)
+        sd = np.sqrt(np.diag(posterior.covariance))
+        return {'fitted': posterior.mean, 'sd': sd, 'target': target, 'z': (posterior.mean - target) / sd}
+
+    def run_sessions(self, timelines):
+        """
+        Simulate a batch of sessions at once.
+        Returns:
+        list: Records of every session, as returned by session_records.
+        """
+        rt, keys = self.respond(timelines)
+        ends = np.cumsum([len(timeline) for timeline in timelines])
+        return [self.session_records(timeline, session_rt, session_keys) for timeline, session_rt, session_keys
+                in zip(timelines, np.split(rt, ends[:-1]), np.split(keys, ends[:-1]))]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the closed loop with a simulated participant.')
+    parser.add_argument('--check-recovery', type=int, metavar='N_SESSIONS',
+                        help='instead, check that a fit on N_SESSIONS random sessions recovers model_beta')
+    args = parser.parse_args()
+    if args.check_recovery:
+        import benchmarks
+
+        recovery = SimulatedParticipant(rng=0).check_recovery(benchmarks.random_timelines(args.check_recovery))
+        for name, fitted, target, z in zip(design_matrix.FEATURE_NAMES, recovery['fitted'], recovery['target'],
+                                           recovery['z']):
+            print(f"{name:<28}{fitted:>10.1f}{target:>10.1f}{z:>8.2f}")
+        if np.max(np.abs(recovery['z'])) > 4:
+            raise SystemExit('The fit does not recover the ground truth')
+    else:
+        # Run the closed loop end to end without a browser
+        import closed_loop
+
+        closed_loop.main(participant=SimulatedParticipant())
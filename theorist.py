@@ -1,162 +1,690 @@
-import numpy as np
-
-
-def run_theory(iteration, posterior_means, posterior_variances, n_samples_mcmc, step_size, X_train, y_train):
-    print('Theorist')
+from concurrent.futures import ProcessPoolExecutor
 
-    # Step 4: Define the likelihood for Bayesian linear regression
-    def gaussian_likelihood(X, y, beta, sigma2):
-        residuals = y - np.dot(X, beta)
-        return -0.5 * np.sum(np.log(2 * np.pi * sigma2) + (residuals ** 2) / sigma2)
+import numpy as np
 
+import diagnostics
+import instrumentation
+
+
+class GaussianLikelihood:
+    """
+    Gaussian log-likelihood of the linear RT model, evaluated from sufficient statistics.
+    X^T X, X^T y, y^T y and n are computed once per fit, so every evaluation costs
+    O(n_params^2) per parameter vector regardless of the number of trials.
+    Parameters:
+    X (array-like): Design matrix of shape (n_trials, n_params).
+    y (array-like): Reaction times of shape (n_trials,).
+    """
+
+    def __init__(self, X, y):
+        X = np.asarray(X, dtype=float)
+        y = np.asarray(y, dtype=float)
+        self.XtX = np.dot(X.T, X)
+        self.Xty = np.dot(X.T, y)
+        self.yty = np.dot(y, y)
+        self.n = len(y)
+
+    def residual_sum_of_squares(self, beta):
+        """
+        Compute ||y - X beta||^2 for a batch of coefficient vectors of shape (n_chains, n_params).
+        """
+        return self.yty - 2 * np.dot(beta, self.Xty) + np.sum(np.dot(beta, self.XtX) * beta, axis=1)
+
+    def __call__(self, beta, sigma2):
+        """
+        Compute the log-likelihood of beta (n_chains, n_params) and sigma2 (n_chains,), shape (n_chains,).
+        """
+        return -0.5 * (self.n * np.log(2 * np.pi * sigma2) + self.residual_sum_of_squares(beta) / sigma2)
+
+    def gradient(self, beta, sigma2):
+        """
+        Gradient of the log-likelihood with respect to beta (n_chains, n_params) and sigma2 (n_chains,).
+        """
+        grad_beta = (self.Xty - np.dot(beta, self.XtX)) / sigma2[:, None]
+        grad_sigma2 = -0.5 * self.n / sigma2 + 0.5 * self.residual_sum_of_squares(beta) / sigma2 ** 2
+        return grad_beta, grad_sigma2
+
+
+def metropolis_hastings(log_posterior, n_params, n_samples, step_size, n_chains=1, rng=None, accumulator=None,
+                        initial_state=None):
+    """
+    Advance n_chains independent random-walk Metropolis-Hastings chains in lockstep.
+    Every step draws one proposal per chain, evaluates all of them with a single call
+    to log_posterior and accepts or rejects them together.
+    Parameters:
+    log_posterior (callable): Maps beta (n_chains, n_params) and sigma2 (n_chains,) to log-densities (n_chains,).
+    n_params (int): Number of regression coefficients.
+    n_samples (int): Number of steps every chain takes.
+    step_size (float): Standard deviation of the Gaussian proposals.
+    n_chains (int): Number of chains advanced together.
+    rng (int or Generator, optional): Seed or random generator.
+    accumulator (SampleAccumulator, optional): Streams every step into the accumulator instead of storing it.
+    initial_state (tuple, optional): beta (n_chains, n_params) and sigma2 (n_chains,) to start from, e.g. from warm_start.
+    Returns:
+    tuple: beta samples (n_samples, n_chains, n_params), sigma2 samples (n_samples, n_chains)
+    and the acceptance rate of every chain (n_chains,). The samples are None with an accumulator.
+    """
+    rng = np.random.default_rng(rng)
+    if initial_state is None:
+        beta_current = rng.standard_normal((n_chains, n_params))  # Initial guess for beta
+        sigma2_current = np.ones(n_chains)  # Initial guess for variance
+    else:
+        beta_current, sigma2_current = (np.array(value, dtype=float) for value in initial_state)
+    log_posterior_current = log_posterior(beta_current, sigma2_current)
+
+    beta_samples, sigma2_samples = None, None
+    if accumulator is None:
+        beta_samples = np.zeros((n_samples, n_chains, n_params))  # Store beta samples
+        sigma2_samples = np.zeros((n_samples, n_chains))  # Store sigma^2 samples
+    acceptance_count = np.zeros(n_chains)
+
+    for i in range(n_samples):
+        # Propose new parameters for beta and sigma2 in every chain
+        beta_proposal = beta_current + rng.standard_normal((n_chains, n_params)) * step_size
+        sigma2_proposal = np.abs(sigma2_current + rng.standard_normal(n_chains) * step_size)
+
+        # Compute the log-posterior for all proposals at once
+        log_posterior_proposal = log_posterior(beta_proposal, sigma2_proposal)
+
+        # Acceptance criterion (log-acceptance ratio)
+        log_accept_ratio = log_posterior_proposal - log_posterior_current
+        accept = np.log(rng.random(n_chains)) < log_accept_ratio
+
+        beta_current = np.where(accept[:, None], beta_proposal, beta_current)
+        sigma2_current = np.where(accept, sigma2_proposal, sigma2_current)
+        log_posterior_current = np.where(accept, log_posterior_proposal, log_posterior_current)
+        acceptance_count += accept
+
+        # Store the current samples
+        if accumulator is None:
+            beta_samples[i] = beta_current
+            sigma2_samples[i] = sigma2_current
+        else:
+            accumulator.add(beta_current, sigma2_current)
+
+    return beta_samples, sigma2_samples, acceptance_count / n_samples
+
+
+def warm_start(beta_samples, sigma2_samples, n_chains, rng=None):
+    """
+    Starting points of n_chains chains drawn from earlier posterior samples, e.g. those of the
+    last checkpoint, so the chains start in the typical set instead of burning in from scratch.
+    Returns:
+    tuple: beta (n_chains, n_params) and sigma2 (n_chains,).
+    """
+    rng = np.random.default_rng(rng)
+    draws = rng.choice(len(beta_samples), n_chains, replace=len(beta_samples) < n_chains)
+    return np.asarray(beta_samples, dtype=float)[draws], np.asarray(sigma2_samples, dtype=float)[draws]
+
+
+def initial_theta(initial_state, n_chains, n_params, rng):
+    """
+    Starting points of the samplers over (beta, log sigma2): initial_state if given, otherwise
+    standard-normal beta and sigma2 = 1.
+    """
+    if initial_state is None:
+        return np.concatenate([rng.standard_normal((n_chains, n_params)), np.zeros((n_chains, 1))], axis=1)
+    beta, sigma2 = initial_state
+    return np.concatenate([np.asarray(beta, dtype=float), np.log(np.asarray(sigma2, dtype=float))[:, None]], axis=1)
+
+
+def adaptation_windows(n_warmup):
+    """
+    Split n_warmup steps into the end points of doubling covariance-adaptation windows.
+    The first 15% of warm-up only tunes the scale and the last 10% only tunes the scale
+    for the final covariance, as in Stan's windowed adaptation.
+    """
+    start, stop = int(0.15 * n_warmup), int(0.9 * n_warmup)
+    ends, size = [], 25
+    while start + size < stop:
+        # Stretch the last window to the end of the slow phase instead of leaving a short one
+        if start + 3 * size >= stop:
+            size = stop - start
+        start += size
+        ends.append(start)
+        size *= 2
+    return ends
+
+
+def adaptive_metropolis_hastings(log_posterior, n_params, n_warmup, max_samples, step_size, n_chains=4,
+                                 target_accept=0.234, target_ess=None, check_every=250, rng=None, accumulator=None,
+                                 initial_state=None):
+    """
+    Adaptive random-walk Metropolis-Hastings over n_chains chains in lockstep.
+    Proposals are made for beta and log(sigma2). During warm-up a per-chain proposal scale
+    is tuned by Robbins-Monro steps toward target_accept, and the proposal covariance is
+    re-estimated from the pooled draws of doubling windows. The proposal is then frozen and
+    sampling continues until the pooled effective sample size of every parameter reaches
+    target_ess or max_samples steps have been taken.
+    Parameters:
+    log_posterior (callable): Maps beta (n_chains, n_params) and sigma2 (n_chains,) to log-densities (n_chains,).
+    n_params (int): Number of regression coefficients.
+    n_warmup (int): Number of adaptation steps per chain, discarded from the output.
+    max_samples (int): Maximum number of kept steps per chain.
+    step_size (float): Initial standard deviation of the proposals.
+    n_chains (int): Number of chains advanced together.
+    target_accept (float): Acceptance rate the proposal scale is tuned toward.
+    target_ess (float, optional): Stop once the minimum pooled ESS reaches this value.
+    check_every (int): Number of steps between ESS checks.
+    rng (int or Generator, optional): Seed or random generator.
+    accumulator (SampleAccumulator, optional): Streams the steps after warm-up into the accumulator
+    instead of storing them; cannot be combined with target_ess.
+    initial_state (tuple, optional): beta (n_chains, n_params) and sigma2 (n_chains,) to start from, e.g. from warm_start.
+    Returns:
+    tuple: beta samples (n_kept, n_chains, n_params), sigma2 samples (n_kept, n_chains)
+    and the acceptance rate of every chain after warm-up (n_chains,). The samples are None with an accumulator.
+    """
+    if accumulator is not None and target_ess is not None:
+        raise ValueError('ESS-based stopping needs the stored samples and cannot stream into an accumulator')
+    rng = np.random.default_rng(rng)
+    n_dims = n_params + 1
+
+    def log_density(theta):
+        # Target density of (beta, log sigma2), including the Jacobian of the log transform
+        return log_posterior(theta[:, :-1], np.exp(theta[:, -1])) + theta[:, -1]
+
+    theta_current = initial_theta(initial_state, n_chains, n_params, rng)
+    log_density_current = log_density(theta_current)
+
+    default_log_scale = np.log(2.38 / np.sqrt(n_dims))
+    log_scale = np.full(n_chains, np.log(step_size))
+    proposal_cholesky = np.eye(n_dims)
+    samples = np.zeros((n_warmup + (0 if accumulator else max_samples), n_chains, n_dims))
+    acceptance_count = np.zeros(n_chains)
+
+    def step(i):
+        nonlocal theta_current, log_density_current
+        noise = np.dot(rng.standard_normal((n_chains, n_dims)), proposal_cholesky.T)
+        theta_proposal = theta_current + np.exp(log_scale)[:, None] * noise
+        log_density_proposal = log_density(theta_proposal)
+        accept = np.log(rng.random(n_chains)) < log_density_proposal - log_density_current
+        theta_current = np.where(accept[:, None], theta_proposal, theta_current)
+        log_density_current = np.where(accept, log_density_proposal, log_density_current)
+        if i < len(samples):
+            samples[i] = theta_current
+        else:
+            accumulator.add(theta_current[:, :-1], np.exp(theta_current[:, -1]))
+        return accept
+
+    # Warm-up: tune the proposal scale every step and the covariance at the end of every window
+    window_ends = adaptation_windows(n_warmup)
+    window_start, adaptation_step = int(0.15 * n_warmup), 0
+    for i in range(n_warmup):
+        accept = step(i)
+        adaptation_step += 1
+        log_scale += adaptation_step ** -0.6 * (accept - target_accept)
+        if i + 1 in window_ends:
+            window = samples[window_start:i + 1].reshape(-1, n_dims)
+            n_window = len(window)
+            covariance = (n_window / (n_window + 5)) * np.cov(window.T) + 1e-3 * (5 / (n_window + 5)) * np.eye(n_dims)
+            proposal_cholesky = np.linalg.cholesky(covariance)
+            log_scale[:] = default_log_scale
+            window_start, adaptation_step = i + 1, 0
+
+    # Sampling with the frozen proposal until the requested ESS is reached
+    n_kept = 0
+    while n_kept < max_samples:
+        for i in range(n_warmup + n_kept, n_warmup + min(n_kept + check_every, max_samples)):
+            acceptance_count += step(i)
+        n_kept = min(n_kept + check_every, max_samples)
+        if target_ess is None:
+            continue
+        ess = diagnostics.effective_sample_size(samples[n_warmup:n_warmup + n_kept])
+        if np.min(ess) >= target_ess:
+            break
+
+    if accumulator is not None:
+        return None, None, acceptance_count / n_kept
+    kept = samples[n_warmup:n_warmup + n_kept]
+    return kept[:, :, :-1], np.exp(kept[:, :, -1]), acceptance_count / n_kept
+
+
+def pool_chains(samples, n_samples):
+    """
+    Concatenate the chains of a (n_steps, n_chains, ...) array and keep the first n_samples draws.
+    """
+    samples = np.swapaxes(samples, 0, 1)
+    return samples.reshape((-1,) + samples.shape[2:])[:n_samples]
+
+
+def check_accumulator(accumulator):
+    """
+    Return the accumulator, raising if its burn-in and thinning left no draws.
+    """
+    if accumulator.n_samples == 0:
+        raise ValueError(f'The accumulator kept no draws of {accumulator.n_steps} steps; reduce its burn_in or thin')
+    return accumulator
+
+
+def conjugate_posterior(likelihood, prior_mean, prior_precision, a0, b0):
+    """
+    Normal-Inverse-Gamma posterior of the linear RT model.
+    The prior is beta | sigma2 ~ N(prior_mean, sigma2 * prior_precision^-1) and sigma2 ~ IG(a0, b0).
+    Parameters:
+    likelihood (GaussianLikelihood): Sufficient statistics of the data.
+    prior_mean (array-like): Prior mean of beta, shape (n_params,).
+    prior_precision (array-like): Prior precision of beta in units of sigma2, shape (n_params, n_params).
+    a0 (float): Prior shape of sigma2.
+    b0 (float): Prior scale of sigma2.
+    Returns:
+    tuple: Posterior mean, precision, shape and scale.
+    """
+    precision = prior_precision + likelihood.XtX
+    mean = np.linalg.solve(precision, np.dot(prior_precision, prior_mean) + likelihood.Xty)
+    a = a0 + likelihood.n / 2
+    b = b0 + 0.5 * (likelihood.yty + prior_mean @ prior_precision @ prior_mean - mean @ precision @ mean)
+    return mean, precision, a, b
+
+
+def sample_normal_inverse_gamma(mean, precision, a, b, n_samples, rng=None):
+    """
+    Draw i.i.d. samples from a Normal-Inverse-Gamma distribution in one vectorized call.
+    Returns:
+    tuple: beta samples (n_samples, n_params) and sigma2 samples (n_samples,).
+    """
+    rng = np.random.default_rng(rng)
+    sigma2_samples = b / rng.gamma(a, size=n_samples)
+    cholesky = np.linalg.cholesky(np.linalg.inv(precision))
+    z = rng.standard_normal((n_samples, len(mean)))
+    beta_samples = mean + np.sqrt(sigma2_samples)[:, None] * np.dot(z, cholesky.T)
+    return beta_samples, sigma2_samples
+
+
+def inverse_gamma_from_samples(sigma2_samples):
+    """
+    Moment-match an inverse-gamma distribution to samples of sigma2.
+    Returns:
+    tuple: Shape and scale.
+    """
+    mean = np.mean(sigma2_samples)
+    a = mean ** 2 / np.var(sigma2_samples) + 2
+    return a, mean * (a - 1)
+
+
+class PosteriorState:
+    """
+    Running Normal-Inverse-Gamma posterior of the linear RT model.
+    Each call to update absorbs a new block of trials in O(n_new_trials * n_params^2),
+    using the current posterior as the prior, so the full covariance between the
+    coefficients is carried from one loop iteration to the next.
+    Parameters:
+    mean (array-like): Posterior mean of beta, shape (n_params,).
+    precision (array-like): Posterior precision of beta in units of sigma2, shape (n_params, n_params).
+    a (float): Posterior shape of sigma2.
+    b (float): Posterior scale of sigma2.
+    """
+
+    def __init__(self, mean, precision, a, b):
+        self.mean = np.asarray(mean, dtype=float)
+        self.precision = np.asarray(precision, dtype=float)
+        self.a = a
+        self.b = b
+        self.n_trials = 0
+
+    @classmethod
+    def initial(cls, n_params):
+        """
+        Create the weak prior used by the 'initial' iteration of run_theory.
+        """
+        return cls(np.zeros(n_params), np.eye(n_params) / 100, 0.0, 0.0)
+
+    @classmethod
+    def from_samples(cls, beta_samples, sigma2_samples):
+        """
+        Moment-match a Normal-Inverse-Gamma posterior to posterior draws, e.g. those returned by run_theory.
+        """
+        a, b = inverse_gamma_from_samples(sigma2_samples)
+        covariance = np.cov(beta_samples, rowvar=False)
+        return cls(np.mean(beta_samples, axis=0), b / (a - 1) * np.linalg.inv(covariance), a, b)
+
+    def update(self, X, y):
+        """
+        Absorb a new block of trials into the posterior.
+        Parameters:
+        X (array-like): Design matrix of the new trials, shape (n_trials, n_params).
+        y (array-like): Reaction times of the new trials, shape (n_trials,).
+        Returns:
+        PosteriorState: The updated state (self).
+        """
+        likelihood = GaussianLikelihood(X, y)
+        self.mean, self.precision, self.a, self.b = conjugate_posterior(
+            likelihood, self.mean, self.precision, self.a, self.b)
+        self.n_trials += likelihood.n
+        return self
+
+    @property
+    def covariance(self):
+        """
+        Marginal posterior covariance of beta.
+        """
+        return self.b / (self.a - 1) * np.linalg.inv(self.precision)
+
+    def sample(self, n_samples, rng=None):
+        """
+        Draw i.i.d. posterior samples, returned as (beta_samples, sigma2_samples).
+        """
+        return sample_normal_inverse_gamma(self.mean, self.precision, self.a, self.b, n_samples, rng)
+
+
+def make_log_posterior(iteration, posterior_means, posterior_variances, likelihood):
+    """
+    Build the batched log-posterior of the MH backends for the given iteration.
+    Parameters:
+    iteration (str): 'initial' for the weak prior, anything else for the posterior-as-prior form.
+    posterior_means (array-like): Prior mean of beta in the 'update' iteration.
+    posterior_variances (array-like): Prior variances or full covariance of beta in the 'update' iteration.
+    likelihood (GaussianLikelihood): Sufficient statistics of the data.
+    Returns:
+    callable: Maps beta (n_chains, n_params) and sigma2 (n_chains,) to log-densities (n_chains,).
+    """
     if iteration == 'initial':
         # Step 5: Define a normal prior for beta coefficients and inverse-gamma prior for sigma2
         def log_prior(beta, sigma2):
-            beta_prior = -0.5 * np.sum(beta ** 2 / 100)  # Normal prior for beta
+            beta_prior = -0.5 * np.sum(beta ** 2 / 100, axis=1)  # Normal prior for beta
             sigma2_prior = -1.0 * np.log(sigma2)  # Weak prior for variance
             return beta_prior + sigma2_prior
-
-        # Step 6: Define the log-posterior combining likelihood and prior
-        def log_posterior(X, y, beta, sigma2):
-            return log_prior(beta, sigma2) + gaussian_likelihood(X, y, beta, sigma2)
-
-        # Step 7: MCMC sampling using Metropolis-Hastings algorithm
-        def metropolis_hastings_regression(X, y, n_samples, step_size):
-            n_params = X.shape[1]  # Number of features (parameters)
-            beta_current = np.random.randn(n_params)  # Initial guess for beta
-            sigma2_current = 1.0  # Initial guess for variance
-            log_posterior_current = log_posterior(X, y, beta_current, sigma2_current)
-
-            beta_samples = np.zeros((n_samples, n_params))  # Store beta samples
-            sigma2_samples = np.zeros(n_samples)  # Store sigma^2 samples
-            acceptance_count = 0
-
-            for i in range(n_samples):
-                # Propose new parameters for beta and sigma2
-                beta_proposal = beta_current + np.random.randn(n_params) * step_size
-                sigma2_proposal = np.abs(sigma2_current + np.random.randn() * step_size)
-
-                # Compute the log-posterior for the proposed parameters
-                log_posterior_proposal = log_posterior(X, y, beta_proposal, sigma2_proposal)
-
-                # Acceptance criterion (log-acceptance ratio)
-                log_accept_ratio = log_posterior_proposal - log_posterior_current
-                accept = np.log(np.random.rand()) < log_accept_ratio
-
-                if accept:
-                    beta_current = beta_proposal
-                    sigma2_current = sigma2_proposal
-                    log_posterior_current = log_posterior_proposal
-                    acceptance_count += 1
-
-                # Store the current samples
-                beta_samples[i, :] = beta_current
-                sigma2_samples[i] = sigma2_current
-
-            acceptance_rate = acceptance_count / n_samples
-            print(f"Acceptance rate: {acceptance_rate:.3f}")
-
-            return beta_samples, sigma2_samples
-
-        return metropolis_hastings_regression(X_train, y_train, n_samples_mcmc, step_size)
-
-        # Step 8: Run MCMC sampling for Bayesian linear regression
-        n_samples_mcmc = 5000  # Number of MCMC samples
-        step_size = 0.1  # Step size for proposals
-        beta_samples_train, sigma2_samples_train = metropolis_hastings_regression(X_train, y_train, n_samples_mcmc,
-                                                                                  step_size)
-
-        # Step 9: Make predictions on the test set using the posterior samples
-        logits_samples_test = np.dot(beta_samples_train, X_test.T)
-        predicted_reaction_times_test = logits_samples_test  # No sigmoid, since it's linear regression
-
-        # Step 10: Calculate the mean and credible interval for the test predictions
-        mean_predicted_reaction_time_test = np.mean(predicted_reaction_times_test, axis=0)
-        lower_bound_test = np.percentile(predicted_reaction_times_test, 2.5, axis=0)
-        upper_bound_test = np.percentile(predicted_reaction_times_test, 97.5, axis=0)
-
-        # Print results
-        print("Mean Predicted Reaction Times:", mean_predicted_reaction_time_test[:10])
-        print("Credible Interval Lower Bound:", lower_bound_test[:10])
-        print("Credible Interval Upper Bound:", upper_bound_test[:10])
-
     else:
         # Step 5: Define the new prior using the posterior from the previous step
-        def log_prior_from_posterior(beta):
-            # Define the prior using the posterior mean and variance
-            return -0.5 * np.sum((beta - posterior_means) ** 2 / posterior_variances)
-
-        # Step 6: Redefine the log-posterior to use the new prior
-        def log_posterior_with_new_prior(X, y, beta, sigma2):
-            return log_prior_from_posterior(beta) + gaussian_likelihood(X, y, beta, sigma2)
-
-        # Step 7: MCMC sampling using the new prior based on the previous posterior
-        def metropolis_hastings_with_new_prior(X, y, n_samples, step_size):
-            n_params = X.shape[1]  # Number of features (parameters)
-            beta_current = np.random.randn(n_params)  # Initial guess for beta
-            sigma2_current = 1.0  # Initial guess for variance
-            log_posterior_current = log_posterior_with_new_prior(X, y, beta_current, sigma2_current)
-
-            beta_samples = np.zeros((n_samples, n_params))  # Store beta samples
-            sigma2_samples = np.zeros(n_samples)  # Store sigma^2 samples
-            acceptance_count = 0
-
-            for i in range(n_samples):
-                # Propose new parameters for beta and sigma2
-                beta_proposal = beta_current + np.random.randn(n_params) * step_size
-                sigma2_proposal = np.abs(sigma2_current + np.random.randn() * step_size)
-
-                # Compute the log-posterior for the proposed parameters
-                log_posterior_proposal = log_posterior_with_new_prior(X, y, beta_proposal, sigma2_proposal)
-
-                # Acceptance criterion (log-acceptance ratio)
-                log_accept_ratio = log_posterior_proposal - log_posterior_current
-                accept = np.log(np.random.rand()) < log_accept_ratio
-
-                if accept:
-                    beta_current = beta_proposal
-                    sigma2_current = sigma2_proposal
-                    log_posterior_current = log_posterior_proposal
-                    acceptance_count += 1
-
-                # Store the current samples
-                beta_samples[i, :] = beta_current
-                sigma2_samples[i] = sigma2_current
-
-            acceptance_rate = acceptance_count / n_samples
-            print(f"Acceptance rate: {acceptance_rate:.3f}")
-
-            return beta_samples, sigma2_samples
-
-        return metropolis_hastings_with_new_prior(X_train, y_train, n_samples_mcmc, step_size)
-
-        # Step 1: Identify the most uncertain points based on the credible interval width
-        uncertain_points_threshold = 0.15  # Define a threshold for high uncertainty
-        uncertain_points_idx = np.where(credible_interval_width_test >= uncertain_points_threshold)[0]
-
-        # Select these uncertain points from the test set
-        X_uncertain = X_test[uncertain_points_idx]
-        y_uncertain = y_test[uncertain_points_idx]
-
-        # Step 2: Add the uncertain points back into the training set
-        X_train_augmented = np.vstack([X_train, X_uncertain])
-        y_train_augmented = np.hstack([y_train, y_uncertain])
-
-        # Step 5: Run the MCMC with the new prior based on the previous posterior
-        beta_samples_train_augmented_with_posterior_prior = metropolis_hastings_with_new_prior(X_train_augmented,
-                                                                                               y_train_augmented,
-                                                                                               n_samples_mcmc,
-                                                                                               step_size)
-
-        # Step 6: Continue with the predictions on the test set...
-
-        # Step 10: Make predictions on the test set using the sampled beta coefficients
-        logits_samples_test = np.dot(beta_samples_train_augmented_with_posterior_prior,
-                                     X_test.T)  # This is the correct dot product
-        predicted_probs_test = sigmoid(logits_samples_test)
-
-        # Step 11: Calculate the mean and credible interval for the test predictions
-        mean_predicted_prob_test = np.mean(predicted_probs_test, axis=0)
-        lower_bound_test = np.percentile(predicted_probs_test, 2.5, axis=0)
-        upper_bound_test = np.percentile(predicted_probs_test, 97.5, axis=0)
-        print(upper_bound_test[:10] - lower_bound_test[:10])
+        if np.ndim(posterior_variances) == 2:
+            prior_precision = np.linalg.inv(posterior_variances)
+
+            def log_prior(beta, sigma2):
+                # Define the prior using the posterior mean and full covariance
+                deviation = beta - posterior_means
+                return -0.5 * np.sum(np.dot(deviation, prior_precision) * deviation, axis=1)
+        else:
+            def log_prior(beta, sigma2):
+                # Define the prior using the posterior mean and variance
+                return -0.5 * np.sum((beta - posterior_means) ** 2 / posterior_variances, axis=1)
+
+    # Step 6: Define the log-posterior combining likelihood and prior
+    def log_posterior(beta, sigma2):
+        return log_prior(beta, sigma2) + likelihood(beta, sigma2)
+
+    return log_posterior
+
+
+def make_log_posterior_gradient(iteration, posterior_means, posterior_variances, likelihood):
+    """
+    Build the gradient of the log-posterior returned by make_log_posterior.
+    Returns:
+    callable: Maps beta (n_chains, n_params) and sigma2 (n_chains,) to the gradients with respect
+    to beta (n_chains, n_params) and sigma2 (n_chains,).
+    """
+    if iteration == 'initial':
+        def prior_gradient(beta, sigma2):
+            return -beta / 100, -1.0 / sigma2
+    else:
+        if np.ndim(posterior_variances) == 2:
+            prior_precision = np.linalg.inv(posterior_variances)
+
+            def prior_gradient(beta, sigma2):
+                return -np.dot(beta - posterior_means, prior_precision), np.zeros_like(sigma2)
+        else:
+            def prior_gradient(beta, sigma2):
+                return -(beta - posterior_means) / posterior_variances, np.zeros_like(sigma2)
+
+    def gradient(beta, sigma2):
+        prior_grad_beta, prior_grad_sigma2 = prior_gradient(beta, sigma2)
+        grad_beta, grad_sigma2 = likelihood.gradient(beta, sigma2)
+        return prior_grad_beta + grad_beta, prior_grad_sigma2 + grad_sigma2
+
+    return gradient
+
+
+def hamiltonian_monte_carlo(log_posterior, gradient, n_params, n_warmup, n_samples, step_size, n_chains=4,
+                            n_leapfrog=16, target_accept=0.8, rng=None, accumulator=None, initial_state=None):
+    """
+    Hamiltonian Monte Carlo over beta and log(sigma2), advancing n_chains chains in lockstep.
+    During warm-up the step size of every chain is tuned by dual averaging toward target_accept
+    and a diagonal mass matrix is estimated from the pooled draws of doubling windows.
+    Parameters:
+    log_posterior (callable): Maps beta (n_chains, n_params) and sigma2 (n_chains,) to log-densities (n_chains,).
+    gradient (callable): Maps beta and sigma2 to the gradients of log_posterior with respect to both.
+    n_params (int): Number of regression coefficients.
+    n_warmup (int): Number of adaptation iterations per chain, discarded from the output.
+    n_samples (int): Number of kept iterations per chain.
+    step_size (float): Initial leapfrog step size.
+    n_chains (int): Number of chains advanced together.
+    n_leapfrog (int): Number of leapfrog steps per iteration.
+    target_accept (float): Mean acceptance probability the step size is tuned toward.
+    rng (int or Generator, optional): Seed or random generator.
+    accumulator (SampleAccumulator, optional): Streams the iterations after warm-up into the accumulator
+    instead of storing them.
+    initial_state (tuple, optional): beta (n_chains, n_params) and sigma2 (n_chains,) to start from, e.g. from warm_start.
+    Returns:
+    tuple: beta samples (n_samples, n_chains, n_params), sigma2 samples (n_samples, n_chains)
+    and the mean acceptance probability of every chain after warm-up (n_chains,).
+    The samples are None with an accumulator.
+    """
+    rng = np.random.default_rng(rng)
+    n_dims = n_params + 1
+
+    def log_density_and_gradient(theta):
+        # Target density of (beta, log sigma2) with the Jacobian of the log transform
+        beta, sigma2 = theta[:, :-1], np.exp(theta[:, -1])
+        grad_beta, grad_sigma2 = gradient(beta, sigma2)
+        grad = np.concatenate([grad_beta, (grad_sigma2 * sigma2 + 1)[:, None]], axis=1)
+        return log_posterior(beta, sigma2) + theta[:, -1], grad
+
+    theta_current = initial_theta(initial_state, n_chains, n_params, rng)
+    log_density_current, grad_current = log_density_and_gradient(theta_current)
+    inverse_mass = np.ones(n_dims)
+    samples = np.zeros((n_warmup + (0 if accumulator else n_samples), n_chains, n_dims))
+    accept_probability_sum = np.zeros(n_chains)
+
+    def transition(i, epsilon):
+        nonlocal theta_current, log_density_current, grad_current
+        momentum = rng.standard_normal((n_chains, n_dims)) / np.sqrt(inverse_mass)
+        kinetic_current = 0.5 * np.sum(momentum ** 2 * inverse_mass, axis=1)
+        theta, grad = theta_current, grad_current
+        eps = (epsilon * rng.uniform(0.9, 1.1, n_chains))[:, None]  # Jitter the step size
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            momentum = momentum + 0.5 * eps * grad
+            for _ in range(n_leapfrog):
+                theta = theta + eps * inverse_mass * momentum
+                log_density, grad = log_density_and_gradient(theta)
+                momentum = momentum + eps * grad
+            momentum = momentum - 0.5 * eps * grad
+            kinetic = 0.5 * np.sum(momentum ** 2 * inverse_mass, axis=1)
+            log_accept = log_density - kinetic - log_density_current + kinetic_current
+        log_accept = np.where(np.isnan(log_accept), -np.inf, log_accept)  # Divergent trajectories are rejected
+        accept = np.log(rng.random(n_chains)) < log_accept
+        theta_current = np.where(accept[:, None], theta, theta_current)
+        log_density_current = np.where(accept, log_density, log_density_current)
+        grad_current = np.where(accept[:, None], grad, grad_current)
+        if i < len(samples):
+            samples[i] = theta_current
+        else:
+            accumulator.add(theta_current[:, :-1], np.exp(theta_current[:, -1]))
+        return np.exp(np.minimum(log_accept, 0))
+
+    # Warm-up: dual averaging of the step size, restarted after every mass matrix update
+    window_ends = adaptation_windows(n_warmup)
+    window_start = int(0.15 * n_warmup)
+    log_epsilon = np.full(n_chains, np.log(step_size))
+    log_epsilon_bar, error_sum, t, mu = np.zeros(n_chains), np.zeros(n_chains), 0, np.log(10 * step_size)
+    for i in range(n_warmup):
+        accept_probability = transition(i, np.exp(log_epsilon))
+        t += 1
+        error_sum += target_accept - accept_probability
+        log_epsilon = mu - np.sqrt(t) / 0.05 * error_sum / (t + 10)
+        log_epsilon_bar = t ** -0.75 * log_epsilon + (1 - t ** -0.75) * log_epsilon_bar
+        if i + 1 in window_ends:
+            window = samples[window_start:i + 1].reshape(-1, n_dims)
+            n_window = len(window)
+            inverse_mass = (n_window / (n_window + 5)) * np.var(window, axis=0) + 1e-3 * (5 / (n_window + 5))
+            mu = np.log(10 * np.exp(np.mean(log_epsilon)))
+            log_epsilon_bar, error_sum, t = np.zeros(n_chains), np.zeros(n_chains), 0
+            window_start = i + 1
+
+    epsilon = np.exp(log_epsilon_bar) if n_warmup > 0 else np.full(n_chains, step_size)
+    for i in range(n_warmup, n_warmup + n_samples):
+        accept_probability_sum += transition(i, epsilon)
+
+    if accumulator is not None:
+        return None, None, accept_probability_sum / n_samples
+    kept = samples[n_warmup:]
+    return kept[:, :, :-1], np.exp(kept[:, :, -1]), accept_probability_sum / n_samples
+
+
+@instrumentation.traced('theorist')
+def run_theory(iteration, posterior_means, posterior_variances, n_samples_mcmc, step_size, X_train, y_train,
+               n_chains=1, rng=None, backend='mh', prior_sigma2=None, adaptive=False, n_warmup=1000,
+               target_accept=0.234, target_ess=None, n_leapfrog=16, accumulator=None, initial_state=None):
+    """
+    Fit the Bayesian linear RT model and return posterior samples of beta and sigma2.
+    With backend='mh' the posterior is sampled with Metropolis-Hastings; with
+    backend='conjugate' a Normal-Inverse-Gamma prior is used and n_samples_mcmc
+    i.i.d. draws are taken from the exact posterior. In the 'update' iteration
+    posterior_variances may be a vector of variances or a full covariance matrix, and
+    the conjugate prior of sigma2 is moment-matched to prior_sigma2, the sigma2 samples
+    of the previous posterior, which the conjugate backend requires in that iteration.
+    The priors of the backends differ in the 'initial' iteration: the MH and HMC backends
+    use beta ~ N(0, 100) in absolute units, whereas the conjugate backend uses
+    beta | sigma2 ~ N(0, 100 sigma2), which with RTs in ms is far weaker, so the two
+    posteriors do not agree on small samples.
+    With adaptive=True the MH proposal is tuned toward target_accept during n_warmup
+    discarded steps, and sampling stops early once the pooled effective sample size of
+    every coefficient reaches target_ess; n_samples_mcmc is then an upper bound.
+    backend='hmc' samples with Hamiltonian Monte Carlo using the analytic gradient of the
+    log-posterior, n_leapfrog steps per iteration and n_warmup adaptation iterations.
+    When a SampleAccumulator is passed, every chain takes ceil(n_samples_mcmc / n_chains)
+    steps after warm-up which are streamed into it (applying its burn-in and thinning)
+    instead of being stored, and the accumulator is returned in place of the samples.
+    The i.i.d. draws of the conjugate backend bypass burn-in and thinning. A ValueError is
+    raised if the accumulator kept no draws.
+    initial_state, e.g. warm_start of the previous posterior's samples, starts the MCMC chains
+    near the posterior, so n_warmup can be reduced; the conjugate backend ignores it.
+    """
+    print('Theorist')
+    X_train = np.asarray(X_train, dtype=float)
+    instrumentation.count('theorist.trials', len(X_train))
+    instrumentation.count('theorist.samples', n_samples_mcmc)
+    # Step 4: Define the likelihood for Bayesian linear regression
+    likelihood = GaussianLikelihood(X_train, y_train)
+
+    if backend == 'conjugate':
+        n_params = X_train.shape[1]
+        if iteration == 'initial':
+            # N(0, 100 sigma2) beta prior and the 1/sigma2 variance prior of the MH backend
+            prior_mean, prior_covariance, a0, b0 = np.zeros(n_params), 100 * np.eye(n_params), 0.0, 0.0
+        else:
+            prior_mean = np.asarray(posterior_means, dtype=float)
+            prior_covariance = np.asarray(posterior_variances, dtype=float)
+            if prior_covariance.ndim == 1:
+                prior_covariance = np.diag(prior_covariance)
+            if prior_sigma2 is None:
+                raise ValueError("The conjugate backend needs prior_sigma2 in the 'update' iteration")
+            a0, b0 = inverse_gamma_from_samples(prior_sigma2)
+            sigma2_scale = b0 / (a0 - 1)
+            # Express the beta prior in units of sigma2
+            prior_covariance = prior_covariance / sigma2_scale
+        mean, precision, a, b = conjugate_posterior(likelihood, prior_mean, np.linalg.inv(prior_covariance), a0, b0)
+        if accumulator is None:
+            return sample_normal_inverse_gamma(mean, precision, a, b, n_samples_mcmc, rng)
+        # Stream the i.i.d. draws in chunks; they need neither burn-in nor thinning
+        rng = np.random.default_rng(rng)
+        for start in range(0, n_samples_mcmc, 1024):
+            accumulator.add_independent(*sample_normal_inverse_gamma(
+                mean, precision, a, b, min(1024, n_samples_mcmc - start), rng))
+        return check_accumulator(accumulator)
+
+    log_posterior = make_log_posterior(iteration, posterior_means, posterior_variances, likelihood)
+
+    # Step 7: MCMC sampling, with the total sample budget split across the chains
+    n_steps = -(-n_samples_mcmc // n_chains)
+    if backend == 'hmc':
+        gradient = make_log_posterior_gradient(iteration, posterior_means, posterior_variances, likelihood)
+        beta_samples, sigma2_samples, acceptance_rate = hamiltonian_monte_carlo(
+            log_posterior, gradient, X_train.shape[1], n_warmup, n_steps, step_size, n_chains, n_leapfrog, rng=rng,
+            accumulator=accumulator, initial_state=initial_state)
+    elif adaptive:
+        beta_samples, sigma2_samples, acceptance_rate = adaptive_metropolis_hastings(
+            log_posterior, X_train.shape[1], n_warmup, n_steps, step_size, n_chains, target_accept, target_ess,
+            rng=rng, accumulator=accumulator, initial_state=initial_state)
+        if accumulator is None:
+            ess = diagnostics.effective_sample_size(beta_samples)
+            print(f"Minimum ESS: {np.min(ess):.0f} from {beta_samples.shape[0] * n_chains} samples")
+    else:
+        beta_samples, sigma2_samples, acceptance_rate = metropolis_hastings(
+            log_posterior, X_train.shape[1], n_steps, step_size, n_chains, rng, accumulator, initial_state)
+    print(f"Acceptance rate: {np.mean(acceptance_rate):.3f}")
+    instrumentation.record('theorist.acceptance_rate', np.mean(acceptance_rate))
+
+    if accumulator is not None:
+        return check_accumulator(accumulator)
+
+    return pool_chains(beta_samples, n_samples_mcmc), pool_chains(sigma2_samples, n_samples_mcmc)
+
+
+def sample_chain(iteration, posterior_means, posterior_variances, n_steps, step_size, X_train, y_train, seed,
+                 adaptive=False, n_warmup=1000, target_accept=0.234, initial_state=None):
+    """
+    Run a single MH chain; used as the work unit of run_theory_parallel.
+    Returns:
+    tuple: beta samples (n_steps, n_params), sigma2 samples (n_steps,) and the acceptance rate.
+    """
+    likelihood = GaussianLikelihood(X_train, y_train)
+    log_posterior = make_log_posterior(iteration, posterior_means, posterior_variances, likelihood)
+    rng = np.random.default_rng(seed)
+    if adaptive:
+        beta_samples, sigma2_samples, acceptance_rate = adaptive_metropolis_hastings(
+            log_posterior, np.shape(X_train)[1], n_warmup, n_steps, step_size, 1, target_accept, rng=rng,
+            initial_state=initial_state)
+    else:
+        beta_samples, sigma2_samples, acceptance_rate = metropolis_hastings(
+            log_posterior, np.shape(X_train)[1], n_steps, step_size, 1, rng, initial_state=initial_state)
+    return beta_samples[:, 0], sigma2_samples[:, 0], acceptance_rate[0]
+
+
+@instrumentation.traced('theorist')
+def run_theory_parallel(iteration, posterior_means, posterior_variances, n_samples_mcmc, step_size, X_train,
+                        y_train, n_chains=4, burn_in=1000, max_workers=None, seed=None, adaptive=False,
+                        n_warmup=1000, target_accept=0.234, initial_state=None):
+    """
+    Run n_chains MH chains in a process pool and merge their draws after burn-in.
+    Every chain gets an independent random stream spawned from seed. The chains keep
+    ceil(n_samples_mcmc / n_chains) draws each after discarding burn_in steps (or, with
+    adaptive=True, after the n_warmup adaptation steps). With an initial_state from warm_start,
+    chain c starts from its row c, and burn_in can be reduced accordingly.
+    Returns:
+    tuple: Pooled beta samples (n_samples, n_params), pooled sigma2 samples (n_samples,) and a
+    convergence report with the split-R-hat and bulk ESS of every coefficient and of sigma2.
+    """
+    print('Theorist')
+    X_train = np.asarray(X_train, dtype=float)
+    y_train = np.asarray(y_train, dtype=float)
+    instrumentation.count('theorist.trials', len(X_train))
+    instrumentation.count('theorist.samples', n_samples_mcmc)
+    n_kept = -(-n_samples_mcmc // n_chains)
+    n_steps = n_kept if adaptive else n_kept + burn_in
+    seeds = np.random.SeedSequence(seed).spawn(n_chains)
+    if initial_state is None:
+        chain_states = [None] * n_chains
+    else:
+        chain_states = [(initial_state[0][chain:chain + 1], initial_state[1][chain:chain + 1])
+                        for chain in range(n_chains)]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(sample_chain, iteration, posterior_means, posterior_variances, n_steps, step_size,
+                                   X_train, y_train, chain_seed, adaptive, n_warmup, target_accept, chain_state)
+                   for chain_seed, chain_state in zip(seeds, chain_states)]
+        chains = [future.result() for future in futures]
+
+    # Stack the chains as (n_draws, n_chains, ...) and drop the burn-in
+    beta_samples = np.stack([chain[0][-n_kept:] for chain in chains], axis=1)
+    sigma2_samples = np.stack([chain[1][-n_kept:] for chain in chains], axis=1)
+    report = {
+        'rhat': diagnostics.split_rhat(beta_samples),
+        'ess': diagnostics.bulk_effective_sample_size(beta_samples),
+        'sigma2_rhat': diagnostics.split_rhat(sigma2_samples),
+        'sigma2_ess': diagnostics.bulk_effective_sample_size(sigma2_samples),
+        'acceptance_rate': np.array([chain[2] for chain in chains]),
+    }
+    print(f"Acceptance rate: {np.mean(report['acceptance_rate']):.3f}")
+    print(f"Max R-hat: {np.max(report['rhat']):.3f}, minimum bulk ESS: {np.min(report['ess']):.0f}")
+    instrumentation.record('theorist.acceptance_rate', np.mean(report['acceptance_rate']))
+    instrumentation.record('theorist.min_ess', np.min(report['ess']))
+
+    return pool_chains(beta_samples, n_samples_mcmc), pool_chains(sigma2_samples, n_samples_mcmc), report
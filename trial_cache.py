@@ -0,0 +1,208 @@
+import contextlib
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import experiment_runner
+import instrumentation
+
+# Root directory of the on-disk cache of synthesized timelines
+CACHE_DIR = os.path.expanduser('~/.cache/closed-loop-experiment/timelines')
+
+
+class TrialPool:
+    """
+    Pre-generated pool of SweetPea timelines for one design and sampler, stored on disk.
+    The pool lives in a directory named after experiment_runner.design_fingerprint, so any
+    change to the factors, crossing, constraints or sampler starts a fresh pool. Every
+    timeline is a JSON file named after the hash of its content. Timelines handed out by
+    take are removed from the pool, which is refilled in a background thread whenever it
+    drops below its target size. Candidates can be inspected with candidates without
+    removing them, and only the one that is run is removed with claim.
+    When the pool cannot cover a request, consumers wait for the shards of the background
+    refill instead of synthesizing the same timelines a second time.
+    A parallel pool creates its worker processes once, with the spawn start method so they are
+    not forked from the threads of the refill, and reuses them for every shard. Call close
+    when done with the pool to stop the refill and shut the workers down.
+    Parameters:
+    iteration (str): 'initial' or 'update', selecting the SweetPea sampler.
+    target_size (int): Number of timelines the background refill keeps in stock.
+    batch_size (int): Number of timelines synthesized per SweetPea call.
+    cache_dir (str): Root directory of the cache.
+    background (bool): Refill the pool in a background thread.
+    parallel (bool): Synthesize in shards of batch_size across a process pool.
+    max_workers (int, optional): Number of worker processes of the parallel synthesis.
+    """
+
+    def __init__(self, iteration, target_size=20, batch_size=5, cache_dir=CACHE_DIR, background=True,
+                 parallel=False, max_workers=None):
+        self.iteration = iteration
+        self.target_size = target_size
+        self.batch_size = batch_size
+        self.background = background
+        self.parallel = parallel
+        self.max_workers = max_workers
+        self.directory = os.path.join(cache_dir, experiment_runner.design_fingerprint(iteration))
+        os.makedirs(self.directory, exist_ok=True)
+        self._executor = ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('spawn')) \
+            if parallel else None
+        self._closed = threading.Event()
+        self._refill_thread = None
+        self._refill_lock = threading.Lock()
+        self.request_refill()
+
+    def __len__(self):
+        return len(self._pool_files())
+
+    def _pool_files(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.json'))
+
+    def add(self, timelines):
+        """
+        Store synthesized timelines in the pool.
+        """
+        for timeline in timelines:
+            content = json.dumps(timeline, sort_keys=True)
+            name = hashlib.sha256(content.encode('utf-8')).hexdigest() + '.json'
+            temporary_path = os.path.join(self.directory, f'.{name}.{os.getpid()}.{threading.get_ident()}.tmp')
+            with open(temporary_path, 'w', encoding='utf-8') as file:
+                file.write(content)
+            # Publish atomically so readers never see a partially written timeline
+            os.replace(temporary_path, os.path.join(self.directory, name))
+
+    def take(self, n=5):
+        """
+        Hand out n timelines, waiting for the refill only if the pool cannot cover the request.
+        Parameters:
+        n (int): Number of timelines.
+        Returns:
+        list: Timelines as lists of trial dictionaries.
+        """
+        timelines = []
+        while True:
+            for name in self._pool_files():
+                if len(timelines) == n:
+                    break
+                timeline = self.claim(name)
+                if timeline is not None:
+                    timelines.append(timeline)
+            if len(timelines) == n:
+                break
+            self.wait_for(n - len(timelines))
+
+        self.request_refill()
+        return timelines
+
+    def candidates(self, n):
+        """
+        Read n random timelines of the pool without removing them, waiting for the refill if the
+        pool holds fewer.
+        Returns:
+        list: (name, timeline) pairs; pass the name of the timeline that is run to claim.
+        """
+        self.wait_for(n)
+        names = self._pool_files()
+        candidates = []
+        for name in random.sample(names, min(n, len(names))):
+            try:
+                with open(os.path.join(self.directory, name), 'r', encoding='utf-8') as file:
+                    candidates.append((name, json.load(file)))
+            except FileNotFoundError:
+                # Claimed by another consumer meanwhile
+                continue
+        return candidates
+
+    def claim(self, name):
+        """
+        Remove a timeline from the pool and return it.
+        Returns:
+        list: The timeline, or None if another consumer claimed it first.
+        """
+        path = os.path.join(self.directory, name)
+        claimed_path = f'{path}.{os.getpid()}.{threading.get_ident()}.claimed'
+        try:
+            # Claim the file first so concurrent consumers never hand out the same timeline
+            os.rename(path, claimed_path)
+        except FileNotFoundError:
+            return None
+        with open(claimed_path, 'r', encoding='utf-8') as file:
+            timeline = json.load(file)
+        os.remove(claimed_path)
+        self.request_refill()
+        return timeline
+
+    def wait_for(self, n):
+        """
+        Block until the pool holds at least n timelines. While the background refill is running,
+        its shards are picked up as they are stored; only a shortfall it does not cover (no
+        background refill, or n above the target size) is synthesized here. The wait is recorded
+        as a synthesis.wait span, since parallel synthesis runs in worker processes whose spans
+        do not reach the trace.
+        """
+        if len(self) >= n:
+            return
+        with instrumentation.span('synthesis.wait', n=n):
+            while len(self) < n:
+                if self.background:
+                    self.request_refill()
+                    thread = self._refill_thread
+                    if thread is not None and thread.is_alive():
+                        thread.join(timeout=0.1)
+                        continue
+                    if len(self) >= n:
+                        break
+                self.add(self.synthesize(max(n - len(self), self.batch_size)))
+
+    def synthesize(self, n):
+        """
+        Synthesize n timelines, in parallel shards if the pool is parallel.
+        """
+        if self.parallel:
+            return experiment_runner.sample_trials_parallel(self.iteration, n, self.batch_size,
+                                                            executor=self._executor)
+        return experiment_runner.sample_trials(self.iteration, n)
+
+    def refill(self):
+        """
+        Synthesize timelines until the pool holds target_size of them or the pool is closed.
+        """
+        while len(self) < self.target_size and not self._closed.is_set():
+            if self.parallel:
+                # Store every shard as soon as it finishes; closing the shards drops the ones not started
+                with contextlib.closing(experiment_runner.iter_trials_parallel(
+                        self.iteration, self.target_size - len(self), self.batch_size,
+                        executor=self._executor)) as shards:
+                    for shard in shards:
+                        self.add(shard)
+                        if self._closed.is_set():
+                            break
+            else:
+                self.add(experiment_runner.sample_trials(self.iteration, self.batch_size))
+
+    def request_refill(self):
+        """
+        Start a background refill unless one is running, the pool is full or closed.
+        """
+        if not self.background or self._closed.is_set() or len(self) >= self.target_size:
+            return
+        with self._refill_lock:
+            if self._refill_thread is None or not self._refill_thread.is_alive():
+                self._refill_thread = threading.Thread(target=self.refill, daemon=True)
+                self._refill_thread.start()
+
+    def close(self):
+        """
+        Stop the background refill and shut down the worker processes of the parallel synthesis.
+        The refill stops after the shard or batch it is synthesizing; timelines in the pool are kept.
+        """
+        self._closed.set()
+        with self._refill_lock:
+            thread = self._refill_thread
+        if thread is not None:
+            thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,194 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+import design_matrix
+import experiment_runner
+import read_experiment_data
+
+# Root directory of the persistent store of collected trials
+STORE_DIR = os.path.expanduser('~/.local/share/closed-loop-experiment/trials')
+
+# Columns of the store and their fixed storage types
+COLUMNS = {
+    'session': np.int32,
+    'iteration': np.int32,
+    'trial': np.int32,
+    'word': '<U6',
+    'color': '<U6',
+    'response_transition': '<U6',
+    'condition': np.int16,
+    'rt': np.float64,
+    'response': '<U1',
+}
+
+
+class TrialStore:
+    """
+    Append-only columnar store of every trial ever collected.
+    Each column is a flat binary file of fixed-size values, read back as a read-only memory
+    map, so the theorist can refit on all trials or on any slice without re-parsing JSON.
+    Appending writes the new rows to the end of every column file and then atomically
+    replaces meta.json, which holds the committed number of rows, the metadata of every
+    session and the condition index. Rows past the committed count, left by an interrupted
+    append, are never read and are cut off by the next append.
+    The condition index keeps the rows ordered by (word, color, response_transition)
+    condition code, with the offset of every condition, so the trials of a condition are a
+    contiguous slice of it.
+    Parameters:
+    directory (str): Directory of the store.
+    """
+
+    def __init__(self, directory=STORE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.n_conditions = len(experiment_runner.WORDS) * len(experiment_runner.COLORS) * \
+            len(experiment_runner.RESPONSE_TRANSITIONS)
+        meta_path = os.path.join(directory, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as file:
+                self.meta = json.load(file)
+        else:
+            self.meta = {'n_rows': 0, 'columns': {name: np.dtype(dtype).str for name, dtype in COLUMNS.items()},
+                         'sessions': [], 'condition_offsets': [0] * (self.n_conditions + 2)}
+
+    def __len__(self):
+        return self.meta['n_rows']
+
+    @property
+    def sessions(self):
+        """
+        Metadata of every stored session, in the order they were appended.
+        """
+        return self.meta['sessions']
+
+    def _path(self, name):
+        return os.path.join(self.directory, f'{name}.bin')
+
+    def append(self, timeline, results, iteration, **metadata):
+        """
+        Store the trials of one session.
+        Parameters:
+        timeline (list): Trial dictionaries of the timeline that was run.
+        results (DataFrame or dict): word, color, rt and response of every trial of the timeline, in timeline order.
+        iteration (int): Loop iteration the session belongs to.
+        metadata: Further JSON-serializable information about the session, e.g. the station.
+        Returns:
+        int: Number of the stored session.
+        Raises:
+        ValueError: If the results do not match the timeline trial by trial (see
+        read_experiment_data.check_timeline); nothing is written then.
+        """
+        n_trials = len(timeline)
+        read_experiment_data.check_timeline(timeline, results)
+        for name in ['rt', 'response']:
+            if len(results[name]) != n_trials:
+                raise ValueError(f'{len(results[name])} {name} values for a timeline of {n_trials} trials')
+        with self._lock:
+            session = len(self.sessions)
+            rows = {
+                'session': np.full(n_trials, session),
+                'iteration': np.full(n_trials, iteration),
+                'trial': np.arange(n_trials),
+                'word': [trial['word'] for trial in timeline],
+                'color': [trial['color'] for trial in timeline],
+                'response_transition': [trial['response_transition'] for trial in timeline],
+                'rt': np.asarray(results['rt']),
+                'response': np.asarray(results['response']),
+            }
+            rows['condition'] = experiment_runner.condition_codes(
+                rows['word'], rows['color'], rows['response_transition'])
+
+            # Write the rows past the committed end of every column, dropping leftovers of an interrupted append
+            for name, dtype in COLUMNS.items():
+                with open(self._path(name), 'ab') as file:
+                    file.truncate(len(self) * np.dtype(dtype).itemsize)
+                    np.asarray(rows[name], dtype=dtype).tofile(file)
+                    file.flush()
+                    os.fsync(file.fileno())
+
+            meta = dict(self.meta)
+            meta['n_rows'] = len(self) + n_trials
+            meta['sessions'] = self.sessions + [dict(metadata, session=session, iteration=iteration,
+                                                     n_trials=n_trials, time=time.time())]
+            meta['condition_offsets'] = self._write_condition_index(meta['n_rows'])
+            self._write_meta(meta)
+            self.meta = meta
+        return session
+
+    def _write_condition_index(self, n_rows):
+        condition = np.memmap(self._path('condition'), dtype=COLUMNS['condition'], mode='r', shape=(n_rows,))
+        # Shift by one so rows with an unknown condition (-1) come first
+        order = np.argsort(condition.astype(np.int64) + 1, kind='stable')
+        counts = np.bincount(condition.astype(np.int64) + 1, minlength=self.n_conditions + 1)
+        temporary_path = self._path('condition_order') + '.tmp'
+        order.astype(np.int64).tofile(temporary_path)
+        os.replace(temporary_path, self._path('condition_order'))
+        return np.concatenate([[0], np.cumsum(counts)]).tolist()
+
+    def _write_meta(self, meta):
+        temporary_path = os.path.join(self.directory, 'meta.json.tmp')
+        with open(temporary_path, 'w') as file:
+            json.dump(meta, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, os.path.join(self.directory, 'meta.json'))
+
+    def column(self, name):
+        """
+        Zero-copy, read-only view of all committed values of a column.
+        """
+        if len(self) == 0:
+            return np.zeros(0, dtype=COLUMNS[name])
+        return np.memmap(self._path(name), dtype=COLUMNS[name], mode='r', shape=(len(self),))
+
+    def read(self, names=None, rows=None):
+        """
+        Read columns, optionally restricted to some rows.
+        Parameters:
+        names (list, optional): Columns to read; all by default.
+        rows (slice or array-like, optional): Rows to read; slices stay zero-copy views.
+        Returns:
+        dict: Arrays of the requested columns.
+        """
+        names = names or list(COLUMNS)
+        if rows is None:
+            return {name: self.column(name) for name in names}
+        return {name: self.column(name)[rows] for name in names}
+
+    def condition_rows(self, word, color, response_transition):
+        """
+        Rows of all trials of one word x color x response transition condition, in order of collection.
+        """
+        code = int(experiment_runner.condition_codes([word], [color], [response_transition])[0])
+        offsets = self.meta['condition_offsets']
+        start, stop = offsets[code + 1], offsets[code + 2]
+        if start == stop:
+            return np.zeros(0, dtype=np.int64)
+        return np.memmap(self._path('condition_order'), dtype=np.int64, mode='r', shape=(len(self),))[start:stop]
+
+    def training_data(self, rows=None):
+        """
+        Design matrix and reaction times of the stored trials, for refitting the theorist.
+        Parameters:
+        rows (slice or array-like, optional): Rows to use; all by default.
+        Returns:
+        tuple: Design matrix X_train and reaction times y_train.
+        """
+        columns = self.read(['condition', 'rt'], rows)
+        return design_matrix.encode_conditions(columns['condition']), np.asarray(columns['rt'])
+
+    def rows(self, iterations=None, sessions=None):
+        """
+        Rows of the trials of the given iterations and sessions (all when None).
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if iterations is not None:
+            mask &= np.isin(self.column('iteration'), iterations)
+        if sessions is not None:
+            mask &= np.isin(self.column('session'), sessions)
+        return np.flatnonzero(mask)